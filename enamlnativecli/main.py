@@ -8,32 +8,85 @@ The full license is in the file COPYING.txt, distributed with this software.
 
 Created on July 10, 2017
 """
-import compileall
+import codecs
+import configparser
 import fnmatch
+import gzip
 import hashlib
+import importlib.util
+import io
 import json
+import lzma
+import marshal
 import os
 import re
 import shutil
+import struct
 import sys
 import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 from argparse import REMAINDER, ArgumentParser, Namespace
-from contextlib import contextmanager
-from distutils.dir_util import copy_tree
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache, partial
 from glob import glob
 from os.path import abspath, dirname, exists, expanduser, join
-from typing import ClassVar
+from typing import Any, ClassVar, Optional, Pattern
 
 from atom.api import Atom, Bool, Dict, Float, Instance, Int, List, Str, Value
-from cookiecutter.log import configure_logger
-from cookiecutter.main import cookiecutter
-from pkg_resources import iter_entry_points
 
-try:
-    # Try conda's version
-    import ruamel_yaml as yaml
-except ImportError:
-    from ruamel import yaml
+
+class LazyModule(object):
+    """Import the first of the modules that can be found when one of it's
+    attributes is used. This keeps the dependencies that are slow to import
+    out of the startup time of commands that don't need them.
+
+    """
+
+    def __init__(self, *names: str):
+        self.__names = names
+        self.__module: Any = None
+
+    def __getattr__(self, attr: str) -> Any:
+        if self.__module is None:
+            for name in self.__names[:-1]:
+                try:
+                    self.__module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    pass
+            else:
+                self.__module = importlib.import_module(self.__names[-1])
+        return getattr(self.__module, attr)
+
+
+def preload(*modules: Any):
+    """Import the modules of the given LazyModules now instead of on first
+    use. The daemon does this so the commands it forks don't each import them.
+
+    """
+    for module in modules:
+        #: Any attribute lookup imports the module
+        getattr(module, "__name__")
+
+
+# Try conda's version
+yaml: Any = LazyModule("ruamel_yaml", "ruamel.yaml")
+asyncio: Any = LazyModule("asyncio")
+
+
+def iter_entry_points(group: str):
+    """Iterate over the entry points installed in the group"""
+    from importlib.metadata import entry_points
+
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return iter(eps.select(group=group))
+    return iter(eps.get(group, []))  # type: ignore
 
 
 IS_WIN = "win" in sys.platform and not "darwin" == sys.platform
@@ -68,7 +121,7 @@ if IS_WIN:
             "Make sure android studio is installed"
         )
 else:
-    import sh  # type: ignore
+    sh = LazyModule("sh")  # type: ignore
 
     ANDROID_SDK = os.environ.get(
         "ANDROID_SDK_ROOT", os.path.expanduser("~/Android/Sdk")
@@ -88,8 +141,11 @@ def print_color(color, msg):
     print(f"{color}{msg}{Colors.RESET}")
 
 
-def find_conda():
-    """Try to find conda on the system"""
+def find_conda_path() -> str:
+    """Try to find the path of conda on the system. Returns an empty string
+    if it can't be found.
+
+    """
     USER_HOME = os.path.expanduser("~")
     CONDA_HOME = os.environ.get("CONDA_HOME", "")
     PROGRAMDATA = os.environ.get("PROGRAMDATA", "")
@@ -115,12 +171,130 @@ def find_conda():
         for name in names:
             cmd = join(conda_path, name)
             if exists(cmd):
-                return sh.Command(cmd)
+                return cmd
+    return ""
+
+
+def find_conda():
+    """Try to find conda on the system"""
+    path = find_conda_path()
+    if path:
+        return sh.Command(path)
 
     # Try to let the system find it
     return sh.conda
 
 
+def conda_info(refresh: bool = False) -> dict:
+    """Return the path of the conda executable and the name of the active
+    env from `conda info`. These are cached in the CONDA_CACHE until the
+    active env or the conda executable changes or refresh is set.
+
+    """
+    key = "{}:{}".format(
+        os.environ.get("CONDA_PREFIX", ""), os.environ.get("CONDA_DEFAULT_ENV", "")
+    )
+    try:
+        with open(CONDA_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    info = cache.get(key)
+    if info and not refresh:
+        try:
+            if os.stat(info["conda"]).st_mtime_ns == info["mtime"]:
+                return info
+        except OSError:
+            pass  # Conda was removed or moved
+
+    path = find_conda_path() or shutil.which("conda") or ""
+    if not path:
+        raise EnvironmentError("conda could not be found")
+    result = json.loads(str(sh.Command(path)("info", "--json")))
+    info = dict(
+        conda=path,
+        mtime=os.stat(path).st_mtime_ns,
+        active_prefix_name=result["active_prefix_name"],
+    )
+    cache[key] = info
+    try:
+        os.makedirs(dirname(CONDA_CACHE), exist_ok=True)
+        with open(CONDA_CACHE, "w") as f:
+            json.dump(cache, f, indent=2)
+    except OSError:
+        pass  # Read only home dir, etc..
+    return info
+
+
+#: Packages read from each conda-meta dir keyed by it's path. Each entry is
+#: the dir's mtime and the packages.
+CONDA_META_CACHE: dict = {}
+
+
+def conda_packages(prefix: str = "") -> dict:
+    """Return a dict of each package installed in the conda prefix (the
+    active env by default) by name. This reads the records in conda-meta
+    directly which is much faster than running `conda list`. The results are
+    cached until the conda-meta dir is modified.
+
+    """
+    prefix = prefix or os.environ.get("CONDA_PREFIX", "")
+    if not prefix:
+        raise FileNotFoundError("No conda env is active")
+    meta = join(prefix, "conda-meta")
+    mtime = os.stat(meta).st_mtime_ns
+    cached = CONDA_META_CACHE.get(meta)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    packages = {}
+    for f in os.listdir(meta):
+        if not f.endswith(".json"):
+            continue
+        #: Records are named <name>-<version>-<build>.json and only the
+        #: name can contain a -
+        name, version, build = f[:-5].rsplit("-", 2)
+        packages[name] = dict(
+            name=name, version=version, build=build, path=join(meta, f)
+        )
+    CONDA_META_CACHE[meta] = (mtime, packages)
+    return packages
+
+
+def pip_packages(prefix: str) -> dict:
+    """Return a dict of each package installed by pip (or any other installer
+    than conda) in the site-packages of the prefix by name. These are listed
+    by `conda list` with the pypi channel.
+
+    """
+    packages = {}
+    site_packages = glob(join(prefix, "lib", "python*", "site-packages"))
+    site_packages.append(join(prefix, "Lib", "site-packages"))
+    for path in site_packages:
+        for info in glob(join(path, "*.dist-info")):
+            try:
+                with open(join(info, "INSTALLER")) as f:
+                    installer = f.read().strip()
+            except OSError:
+                installer = ""
+            if installer == "conda":
+                continue
+            name, version = os.path.basename(info)[:-10].rsplit("-", 1)
+            name = name.lower().replace("_", "-")
+            packages[name] = dict(
+                name=name, version=version, build="pypi_0", channel="pypi", path=info
+            )
+    return packages
+
+
+def conda_package_version(name: str, prefix: str = "") -> str:
+    """Return the version of the package installed in the conda prefix or an
+    empty string if it is not installed.
+
+    """
+    package = conda_packages(prefix).get(name)
+    return package["version"] if package else ""
+
+
 class Colors:
     RED = "\033[1;31m"
     BLUE = "\033[1;34m"
@@ -143,68 +317,1686 @@ def cd(newdir: str):
         os.chdir(prevdir)
 
 
-def cp(src: str, dst: str):
-    """Like cp -R src dst"""
+#: How cp creates each file. Auto uses a reflink (a copy-on-write clone on
+#: btrfs, xfs, etc..) if the filesystem supports it and falls back to a copy.
+#: Hardlinks must be opted into as the files are then shared with the source.
+COPY_MODES = ["auto", "copy", "reflink", "hardlink"]
+
+#: The FICLONE ioctl from linux/fs.h
+FICLONE = 0x40049409
+
+#: If reflinks work between the devices of a src and dst
+REFLINK_SUPPORT: dict = {}
+
+
+def reflink(src: str, dst: str) -> bool:
+    """Clone src to dst without copying the data. Returns False if the
+    platform or filesystem does not support it. Once a clone fails it's not
+    tried again for the same devices.
+
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    devices = (os.stat(src).st_dev, os.stat(dirname(abspath(dst))).st_dev)
+    if not REFLINK_SUPPORT.get(devices, True):
+        return False
+    import fcntl
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            REFLINK_SUPPORT[devices] = True
+            return True
+        except OSError:
+            REFLINK_SUPPORT[devices] = False
+    os.remove(dst)
+    return False
+
+
+def same_contents(a: str, b: str) -> bool:
+    """Return if the two files have the same bytes. Unlike filecmp this never
+    uses a cached result based on the size and mtime.
+
+    """
+    if os.path.samefile(a, b):
+        return True
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        while True:
+            chunk = fa.read(1 << 20)
+            if chunk != fb.read(1 << 20):
+                return False
+            if not chunk:
+                return True
+
+
+def copy_file(src: str, dst: str, mode: str = "auto") -> bool:
+    """Copy src to dst using the given mode (see COPY_MODES) unless dst
+    already has the same size and mtime. Staged sources all have the
+    BUNDLE_MTIME so those are only skipped if the contents also match. The
+    mode and mtime of the src are kept. Returns True if the file was copied.
+
+    """
+    stat = os.stat(src)
+    try:
+        old = os.stat(dst)
+        mtime = int(stat.st_mtime)
+        same = old.st_size == stat.st_size and int(old.st_mtime) == mtime
+        if same and (mtime != BUNDLE_MTIME or same_contents(src, dst)):
+            return False
+        #: Never write into a file that may be linked to another
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass  # Eg a different device
+    if mode in ("auto", "reflink") and reflink(src, dst):
+        shutil.copystat(src, dst)
+    else:
+        shutil.copy2(src, dst)
+    return True
+
+
+def cp(src: str, dst: str, mode: str = "auto", jobs: int = 0) -> tuple:
+    """Like cp -R src dst but skips files that are unchanged and copies large
+    trees using a pool of threads. Returns a tuple of the bytes copied and
+    the bytes skipped.
+
+    """
     print(f"[DEBUG] copying {src} to {dst}")
     if os.path.isfile(src):
-        if not exists(dirname(dst)):
-            os.makedirs(dirname(dst))
-        shutil.copy(src, dst)
+        files = [(src, dst)]
     else:
-        copy_tree(src, dst)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+            rel = os.path.relpath(dirpath, src)
+            for name in filenames:
+                files.append(
+                    (join(dirpath, name), os.path.normpath(join(dst, rel, name)))
+                )
+    for d in {dirname(f) for s, f in files}:
+        if d:
+            os.makedirs(d, exist_ok=True)
+
+    def copy(paths: tuple) -> tuple:
+        size = os.path.getsize(paths[0])
+        return (size, 0) if copy_file(paths[0], paths[1], mode) else (0, size)
+
+    if len(files) > 64:
+        with ThreadPoolExecutor(max_workers=jobs or None) as pool:
+            results = list(pool.map(copy, files))
+    else:
+        results = [copy(paths) for paths in files]
+    copied = sum(c for c, s in results)
+    skipped = sum(s for c, s in results)
+    print(
+        f"[DEBUG] copied {format_size(copied)}, "
+        f"skipped {format_size(skipped)} unchanged"
+    )
+    return copied, skipped
+
+
+#: Most bytes read from the output of a command at once
+SHPRINT_CHUNK_SIZE = 1 << 16
+
+#: Seconds between redraws of the output line when not in debug mode
+SHPRINT_REFRESH_INTERVAL = 0.1
+
+
+def write_output(chunks, debug: bool = True):
+    """Write the chunks of output of a command. In debug mode the output is
+    written as is, otherwise each line is drawn over the last one but at most
+    once every SHPRINT_REFRESH_INTERVAL seconds.
+
+    """
+    write, flush = sys.stdout.write, sys.stdout.flush
+    decode = codecs.getincrementaldecoder("utf-8")(errors="ignore").decode
+
+    def draw(msg):
+        color = Colors.RED if "error" in msg else Colors.RESET
+        write("{}\r[DEBUG]       {:<{w}}{}".format(color, msg, Colors.RESET, w=100))
+
+    buf, msg, last = "", None, 0.0
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decode(chunk)
+        if debug:
+            write(chunk)
+            flush()
+            continue
+        lines = re.split("[\r\n]", buf + chunk)
+        buf = lines.pop()
+        if lines:
+            msg = lines[-1]
+        now = time.monotonic()
+        if msg is None or now - last < SHPRINT_REFRESH_INTERVAL:
+            continue
+        last = now
+        draw(msg)
+        flush()
+        msg = None
+
+    # The last line may not have been drawn yet
+    if msg is not None:
+        draw(msg)
+    write("\n")
+    flush()
 
 
 def shprint(cmd, *args, **kwargs):
     debug = kwargs.pop("_debug", True)
-    bufsize = kwargs.pop("_out_bufsize", 0)
-    write, flush = sys.stdout.write, sys.stdout.flush
-    kwargs.update({"_err_to_out": True, "_out_bufsize": bufsize, "_iter": True})
+    bufsize = kwargs.pop("_out_bufsize", 0) or SHPRINT_CHUNK_SIZE
 
     arg_list = " ".join([a for a in args if not isinstance(a, sh.RunningCommand)])
     print_color(Colors.CYAN, f"[INFO ] running  {cmd} {arg_list}")
 
+    def read_chunks(read):
+        """Read chunks of up to bufsize until the output is closed"""
+        while True:
+            chunk = read(bufsize)
+            if not chunk:
+                return
+            yield chunk
+
     if IS_WIN:
-        kwargs.pop("_out_bufsize")
-        kwargs.pop("_iter")
-        kwargs["_bg"] = True
+        kwargs.update({"_err_to_out": True, "_bg": True})
         process = cmd(*args, **kwargs).process
-        for c in iter(lambda: process.stdout.read(1), ""):
-            if isinstance(c, bytes):
-                c = c.decode("utf-8", errors="ignore")
-            write(c)
-            if c == "\r" or c == "\n":
-                flush()
-            if not c:
-                break
+        read = getattr(process.stdout, "read1", process.stdout.read)
+        write_output(read_chunks(read), debug)
         process.wait()
         return
 
-    buf = []
-    if debug:
-        for c in cmd(*args, **kwargs):
-            if isinstance(c, bytes):
-                c = c.decode("utf-8", errors="ignore")
-            write(c)
-            if c == b"\r" or c == b"\n":
-                flush()
+    # Read the output from a pipe directly, sh reads unbuffered output a byte
+    # at a time
+    r, w = os.pipe()
+    with open(r, "rb", buffering=0) as f:
+        try:
+            kwargs.update(
+                {"_err_to_out": True, "_out": w, "_bg": True, "_bg_exc": False}
+            )
+            process = cmd(*args, **kwargs)
+        finally:
+            os.close(w)
+        write_output(read_chunks(f.read), debug)
+    process.wait()
+
+
+#: Colors used to tell the output of concurrent commands apart
+RUNNER_COLORS = (Colors.CYAN, Colors.GREEN, Colors.BLUE, Colors.BOLD)
+
+
+class RunResult(Atom):
+    """The result of a command run by run_commands"""
+
+    #: Name the output of the command is prefixed with
+    name = Str()
+
+    #: Command line that was run
+    args = List()
+
+    #: Exit code of the command. It's negative if killed by a signal.
+    exit_code = Int()
+
+    #: Wall time in seconds
+    duration = Float()
+
+    #: Last lines of the output
+    tail = List()
+
+    #: If the command was stopped because another one failed
+    cancelled = Bool()
+
+
+class CommandFailed(RuntimeError):
+    """Raised by run_commands when a command exits with an error"""
+
+    def __init__(self, result: RunResult, results: list):
+        super().__init__(
+            f"'{' '.join(result.args)}' failed with exit code {result.exit_code}"
+        )
+        #: The result of the command that failed
+        self.result = result
+
+        #: The results of all the commands
+        self.results = results
+
+
+async def run_command(result: RunResult, kwargs: dict, color: str, limit, tail: int):
+    """Run the command of the result once the limit semaphore allows and
+    print each line of it's output prefixed by the name.
+
+    """
+    prefix = f"{color}[{result.name}]{Colors.RESET} "
+    decode = codecs.getincrementaldecoder("utf-8")(errors="ignore").decode
+    lines: deque = deque(maxlen=tail)
+
+    def write(text: str):
+        for line in text.split("\n"):
+            #: Only show the last update of progress lines
+            line = line.rstrip("\r").rsplit("\r", 1)[-1]
+            lines.append(line)
+            print(f"{prefix}{line}")
+        sys.stdout.flush()
+
+    async with limit:
+        start = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            *result.args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            **kwargs,
+        )
+        try:
+            buf = ""
+            while True:
+                chunk = await process.stdout.read(SHPRINT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buf += decode(chunk)
+                if "\n" in buf:
+                    text, buf = buf.rsplit("\n", 1)
+                    write(text)
+            if buf:
+                write(buf)
+            result.exit_code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), 5)
+                except asyncio.TimeoutError:
+                    process.kill()
+            result.exit_code = await process.wait()
+            print_color(Colors.RED, f"[{result.name}] cancelled")
+            raise
+        finally:
+            result.duration = time.monotonic() - start
+            result.tail = list(lines)
+
+    if result.exit_code:
+        print_color(
+            Colors.RED,
+            f"[{result.name}] failed with exit code {result.exit_code} "
+            f"after {result.duration:.1f}s",
+        )
+        raise CommandFailed(result, [])
+    print(f"{prefix}done in {result.duration:.1f}s")
+
+
+async def run_commands_async(
+    commands: list, jobs: int = 0, check: bool = True, tail: int = 20
+) -> list:
+    """Run the commands concurrently, at most jobs at a time, and return a
+    RunResult for each. See run_commands.
+
+    """
+    limit = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+    results, tasks = [], []
+    for i, (name, args, *options) in enumerate(commands):
+        result = RunResult(name=name, args=[str(arg) for arg in args])
+        color = RUNNER_COLORS[i % len(RUNNER_COLORS)]
+        kwargs = options[0] if options else {}
+        results.append(result)
+        tasks.append(
+            asyncio.ensure_future(run_command(result, kwargs, color, limit, tail))
+        )
+    if not tasks:
+        return results
+
+    #: Stop the others when one fails
+    done, pending = await asyncio.wait(
+        tasks, return_when=asyncio.FIRST_EXCEPTION if check else asyncio.ALL_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task, result in zip(tasks, results):
+        result.cancelled = task in pending
+    for task in tasks:
+        e = None if task in pending else task.exception()
+        if isinstance(e, CommandFailed):
+            if not check:
+                continue
+            e.results = results
+        if e is not None:
+            raise e
+    return results
+
+
+def run_commands(
+    commands: list, jobs: int = 0, check: bool = True, tail: int = 20
+) -> list:
+    """Run the commands concurrently and return a RunResult for each.
+
+    Each command is a tuple of a name, the list of args and optionally a dict
+    of kwargs for asyncio.create_subprocess_exec (eg cwd or env). At most jobs
+    (the cpu count by default) are run at a time. The output of each is
+    printed as it's read with every line prefixed by it's name.
+
+    If check is set and a command fails the others are stopped and a
+    CommandFailed error is raised. The results keep the last tail lines of
+    output of each command.
+
+    """
+    return asyncio.run(run_commands_async(commands, jobs, check, tail))
+
+
+#: Bump whenever the layout of the bundle manifest changes
+BUNDLE_MANIFEST_VERSION = 3
+
+
+def file_digest(path: str) -> str:
+    """Return the sha256 hexdigest of a file's contents"""
+    m = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Translate a glob pattern to a regex. Unlike fnmatch a * or ? never
+    matches a / and ** matches any number of directories.
+
+    """
+    i, n = 0, len(pattern)
+    result = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern.startswith("*", i):
+                i += 1
+                if pattern.startswith("/", i):
+                    i += 1
+                    result.append("(?:.*/)?")
+                else:
+                    result.append(".*")
+            else:
+                result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "[":
+            j = i
+            if pattern.startswith("!", j):
+                j += 1
+            if pattern.startswith("]", j):
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                result.append("\\[")
+                continue
+            chars = pattern[i:j].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            result.append(f"[{chars}]")
+            i = j + 1
+        else:
+            result.append(re.escape(c))
+    return "".join(result)
+
+
+@lru_cache()
+def compile_excluded(patterns: tuple) -> Pattern:
+    """Merge the excluded glob patterns into a single regex that matches a
+    path (relative to the bundle root) if it or any parent directory is
+    excluded.
+
+    Patterns match at any depth (so `idlelib` excludes `python/idlelib`)
+    unless they start with a `/` which anchors them to the root.
+
+    """
+    anchored = [glob_to_regex(p[1:]) for p in patterns if p.startswith("/")]
+    floating = [glob_to_regex(p) for p in patterns if p and not p.startswith("/")]
+    options = []
+    if floating:
+        options.append("(?:.*/)?(?:{})".format("|".join(floating)))
+    if anchored:
+        options.append("(?:{})".format("|".join(anchored)))
+    if not options:
+        return re.compile(r"(?!)")  # Match nothing
+    return re.compile("(?:{})(?:/.*)?$".format("|".join(options)))
+
+
+def is_excluded(path: str, patterns: list) -> bool:
+    """Returns true if the path (relative to the bundle root) or any of it's
+    parent directories match one of the excluded glob patterns.
+
+    """
+    return compile_excluded(tuple(patterns)).match(path) is not None
+
+
+#: Default location of the compiled python cache shared by all apps
+PYC_CACHE_DIR = join(
+    os.environ.get("XDG_CACHE_HOME", expanduser("~/.cache")), "enaml-native", "pyc"
+)
+
+#: Default location of the stripped native libs cache shared by all apps
+STRIP_CACHE_DIR = join(dirname(PYC_CACHE_DIR), "strip")
+
+
+#: Pyc invalidation modes mapped to the flags saved in the pyc header
+PYC_INVALIDATION_MODES = {
+    "timestamp": 0b00,
+    "checked-hash": 0b11,
+    "unchecked-hash": 0b01,
+}
+
+
+def compile_pyc(
+    path: str,
+    dfile: str = "",
+    cache_dir: str = "",
+    in_memory: bool = False,
+    optimize: int = 0,
+    invalidation: str = "timestamp",
+) -> tuple:
+    """Compile a python file to a pyc at the given optimization level using
+    one of the PYC_INVALIDATION_MODES. If a cache dir is given and it contains
+    a pyc of the same source it is used instead of compiling again.
+
+    The pyc is written to the file's __pycache__ dir unless in_memory is set
+    in which case it is returned using the bundle's fixed mtime so the source
+    never needs to be staged. The dfile is the filename saved in the code
+    (defaults to the path).
+
+    Returns a tuple of (dfile, cached, error, data).
+
+    """
+    dfile = dfile or path
+    try:
+        with open(path, "rb") as f:
+            source = f.read()
+        mtime = BUNDLE_MTIME if in_memory else int(os.stat(path).st_mtime)
+    except OSError as e:
+        return (dfile, False, str(e), b"")
+
+    #: The dfile is included since it is saved as the code's filename
+    m = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+    m.update(f"{optimize}:{dfile}".encode())
+    m.update(source)
+    key = m.hexdigest()
+    cached = join(cache_dir, key[:2], f"{key}.pyc") if cache_dir else ""
+
+    hit = bool(cached) and exists(cached)
+    if hit:
+        with open(cached, "rb") as f:
+            data = bytearray(f.read())
     else:
-        for c in cmd(*args, **kwargs):
-            if isinstance(c, bytes):
-                c = c.decode("utf-8", errors="ignore")
-            if c == "\r" or c == "\n":
-                msg = "".join(buf)
-                color = Colors.RED if "error" in msg else Colors.RESET
-                write(
-                    "{}\r[DEBUG]       {:<{w}}{}".format(
-                        color, msg, Colors.RESET, w=100
-                    )
+        try:
+            code = compile(source, dfile, "exec", dont_inherit=True, optimize=optimize)
+        except (SyntaxError, ValueError) as e:
+            return (dfile, False, f"{type(e).__name__}: {e}", b"")
+        data = bytearray(importlib.util.MAGIC_NUMBER)
+        data.extend(bytes(12))  # Flags, mtime and size or hash are set below
+        data.extend(marshal.dumps(code))
+        if cached:
+            save_cached(cached, data)
+
+    flags = PYC_INVALIDATION_MODES[invalidation]
+    data[4:8] = flags.to_bytes(4, "little")
+    if flags:
+        data[8:16] = importlib.util.source_hash(source)
+    else:
+        #: Timestamp based pyc's must match the mtime and size of the source
+        data[8:12] = (mtime & 0xFFFFFFFF).to_bytes(4, "little")
+        data[12:16] = (len(source) & 0xFFFFFFFF).to_bytes(4, "little")
+    if in_memory:
+        return (dfile, hit, "", bytes(data))
+
+    cfile = bytecode_path(path, optimize)
+    os.makedirs(dirname(cfile), exist_ok=True)
+    with open(cfile, "wb") as f:
+        f.write(data)
+    return (dfile, hit, "", b"")
+
+
+def compile_enaml(
+    path: str,
+    dfile: str = "",
+    cache_dir: str = "",
+    in_memory: bool = False,
+    optimize: int = 0,
+    invalidation: str = "timestamp",
+) -> tuple:
+    """Compile an enaml file to the cache file enaml's importer loads, the
+    same way compile_pyc does for python files. Enaml cache files are always
+    timestamp based and not optimized so those options are ignored.
+
+    Returns a tuple of (dfile, cached, error, data).
+
+    """
+    from enaml.core.enaml_compiler import EnamlCompiler
+    from enaml.core.import_hooks import MAGIC_TAG
+    from enaml.core.parser import parse
+
+    dfile = dfile or path
+    try:
+        with open(path, "rb") as f:
+            source = f.read()
+        mtime = BUNDLE_MTIME if in_memory else int(os.stat(path).st_mtime)
+    except OSError as e:
+        return (dfile, False, str(e), b"")
+
+    m = hashlib.sha256(MAGIC_TAG.encode())
+    m.update(dfile.encode())
+    m.update(source)
+    key = m.hexdigest()
+    cached = join(cache_dir, key[:2], f"{key}.enamlc") if cache_dir else ""
+
+    hit = bool(cached) and exists(cached)
+    if hit:
+        with open(cached, "rb") as f:
+            data = bytearray(f.read())
+    else:
+        try:
+            text = io.TextIOWrapper(io.BytesIO(source), newline=None).read()
+            code = EnamlCompiler.compile(parse(text, dfile), dfile)
+        except Exception as e:
+            return (dfile, False, f"{type(e).__name__}: {e}", b"")
+        data = bytearray(importlib.util.MAGIC_NUMBER)
+        data.extend(bytes(4))  # Mtime is set below
+        data.extend(marshal.dumps(code))
+        if cached:
+            save_cached(cached, data)
+
+    #: The cache is used if it's mtime is not older than the source
+    data[4:8] = (mtime & 0xFFFFFFFF).to_bytes(4, "little")
+    if in_memory:
+        return (dfile, hit, "", bytes(data))
+
+    cfile = bytecode_path(path)
+    os.makedirs(dirname(cfile), exist_ok=True)
+    with open(cfile, "wb") as f:
+        f.write(data)
+    return (dfile, hit, "", b"")
+
+
+def compile_file(path: str, dfile: str = "", **kwargs) -> tuple:
+    """Compile a python or enaml file with compile_pyc or compile_enaml"""
+    if path.endswith(".enaml"):
+        return compile_enaml(path, dfile, **kwargs)
+    return compile_pyc(path, dfile, **kwargs)
+
+
+def bytecode_path(path: str, optimize: int = 0) -> str:
+    """Return the path the compiled python or enaml file is loaded from"""
+    if path.endswith(".enaml"):
+        from enaml.core.import_hooks import make_file_info
+
+        return make_file_info(path).cache_path
+    return importlib.util.cache_from_source(path, optimization=optimize or "")
+
+
+def save_cached(path: str, data):
+    """Save a compiled file to the cache. It is written to a temp file first
+    so other processes never read a partially written file.
+
+    """
+    os.makedirs(dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def compile_sources(
+    paths: list,
+    jobs: int = 0,
+    cache_dir: str = "",
+    dfiles=None,
+    optimize: int = 0,
+    invalidation: str = "timestamp",
+) -> tuple:
+    """Compile the python and enaml files using a pool of worker processes.
+    If jobs is not set the cpu count is used. See compile_pyc for the
+    optimize and invalidation options.
+
+    If a list of dfiles (the path of each file within the bundle) is given the
+    files are compiled in memory instead of being written next to the source.
+
+    Returns a tuple of the number compiled, the number loaded from the cache,
+    a list of files that failed to compile and a dict of the in memory pycs
+    keyed by their path in the bundle.
+
+    """
+    jobs = jobs or os.cpu_count() or 1
+    in_memory = dfiles is not None
+    if dfiles is None:
+        dfiles = [""] * len(paths)
+    worker = partial(
+        compile_file,
+        cache_dir=cache_dir,
+        in_memory=in_memory,
+        optimize=optimize,
+        invalidation=invalidation,
+    )
+    if jobs == 1 or len(paths) < 2:
+        results = list(map(worker, paths, dfiles))
+    else:
+        chunksize = max(1, len(paths) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(worker, paths, dfiles, chunksize=chunksize))
+
+    compiled, cached, failed, pycs = 0, 0, [], {}
+    for dfile, hit, error, data in results:
+        if error:
+            print_color(Colors.RED, f"[WARNING] Could not compile {dfile}: {error}")
+            failed.append(dfile)
+            continue
+        if hit:
+            cached += 1
+        else:
+            compiled += 1
+        if in_memory:
+            pycs[bytecode_path(dfile, optimize)] = data
+    return compiled, cached, failed, pycs
+
+
+#: Bundle archive formats mapped to the file extension each uses
+BUNDLE_FORMATS = {
+    "gz": "tar.gz",
+    "xz": "tar.xz",
+    "zstd": "tar.zst",
+    "lz4": "tar.lz4",
+    "tar": "tar",
+    "zip": "zip",
+}
+
+#: Extensions of any bundle that may need cleaned up (including old ones)
+BUNDLE_EXTENSIONS = sorted(set(BUNDLE_FORMATS.values()) | {"so"})
+
+
+#: Name of the manifest installed next to the bundle that tells the app
+#: runtime how to load it
+RUNTIME_MANIFEST = "bundle.json"
+
+#: Fixed mtime given to every file in the bundle so identical sources always
+#: produce an identical archive. Zip can't store anything before 1980.
+BUNDLE_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", 315532800))
+
+
+def iter_tree(path: str, arcname: str = "."):
+    """Yield an (arcname, source) bundle entry for path and everything under
+    it in a sorted order. The source is None for directories.
+
+    """
+    if not os.path.isdir(path):
+        yield arcname, path
+        return
+    yield arcname, None
+    for name in sorted(os.listdir(path)):
+        yield from iter_tree(join(path, name), f"{arcname}/{name}")
+
+
+def iter_bundle_entries(files: dict):
+    """Yield (arcname, source) bundle entries for the files and all of their
+    parent directories in the same order as iter_tree. The files map each path
+    in the bundle to either the filename to read or it's contents.
+
+    """
+    dirs = set()
+    for path in files:
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            dirs.add("/".join(parts[:i]))
+    yield ".", None
+    for path in sorted(dirs.union(files), key=lambda p: p.split("/")):
+        yield f"./{path}", files.get(path)
+
+
+def normalize_tarinfo(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    """Strip any metadata that would make the archive differ between builds"""
+    info.mtime = BUNDLE_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    info.mode = 0o755 if info.isdir() or info.mode & 0o111 else 0o644
+    return info
+
+
+class CountingFile:
+    """Wraps a file opened for writing to count the bytes written to it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, data) -> int:
+        n = self.f.write(data)
+        self.count += n
+        return n
+
+    def tell(self) -> int:
+        return self.count
+
+    def flush(self):
+        self.f.flush()
+
+
+def write_bundle(path: str, entries, fmt: str = "gz", level=None, threads: int = 0):
+    """Write the bundle entries to an archive at path using one of the
+    BUNDLE_FORMATS. Entries are (arcname, source) tuples where the source is
+    a filename, the file contents or None for a directory (see iter_tree).
+
+    If level is None the codec's default level is used. Threads is only used
+    by codecs that support multithreaded compression (zstd), if zero all
+    cores are used.
+
+    Entry metadata is normalized so the same sources always produce the same
+    archive.
+
+    Returns a list of the [path, size, compressed size] of each file. For
+    compressed tar formats the compressed size is an estimate as the codec
+    buffers it's output.
+
+    """
+    sizes: list = []
+    if fmt == "zip":
+        #: Members are stored unless a compression level is given
+        compression = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+        date_time = time.gmtime(BUNDLE_MTIME)[:6]
+        with zipfile.ZipFile(path, "w", compression, compresslevel=level) as zf:
+            for arcname, source in entries:
+                if source is None:
+                    continue
+                zinfo = zipfile.ZipInfo(arcname[2:], date_time)
+                zinfo.compress_type = compression
+                zinfo.external_attr = 0o644 << 16
+                if not isinstance(source, bytes):
+                    with open(source, "rb") as f:
+                        source = f.read()
+                zf.writestr(zinfo, source, compresslevel=level)
+                sizes.append([zinfo.filename, zinfo.file_size, zinfo.compress_size])
+        return sizes
+
+    with ExitStack() as stack:
+        out = CountingFile(stack.enter_context(open(path, "wb")))
+        if fmt == "gz":
+            #: Use a fixed timestamp and no filename in the gzip header
+            gz = stack.enter_context(
+                gzip.GzipFile(
+                    filename="",
+                    mode="wb",
+                    fileobj=out,
+                    compresslevel=9 if level is None else level,
+                    mtime=0,
                 )
-                flush()
-                buf = []
-            else:
-                buf.append(c)
-    write("\n")
-    flush()
+            )
+            tar = tarfile.open(fileobj=gz, mode="w")
+        elif fmt == "xz":
+            xz = stack.enter_context(lzma.LZMAFile(out, "w", preset=level))  # type: ignore
+            tar = tarfile.open(fileobj=xz, mode="w")
+        elif fmt == "tar":
+            tar = tarfile.open(fileobj=out, mode="w")  # type: ignore
+        elif fmt == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                msg = "[WARNING] zstandard is required for zstd bundles: Run 'pip install zstandard'"
+                print_color(Colors.RED, msg)
+                raise
+            cctx = zstandard.ZstdCompressor(
+                level=3 if level is None else level, threads=threads or -1
+            )
+            stream = stack.enter_context(cctx.stream_writer(out))  # type: ignore
+            tar = tarfile.open(fileobj=stream, mode="w|")
+        elif fmt == "lz4":
+            try:
+                import lz4.frame
+            except ImportError:
+                msg = "[WARNING] lz4 is required for lz4 bundles: Run 'pip install lz4'"
+                print_color(Colors.RED, msg)
+                raise
+            stream = stack.enter_context(
+                lz4.frame.open(out, "wb", compression_level=level or 0)
+            )
+            tar = tarfile.open(fileobj=stream, mode="w|")
+        else:
+            raise ValueError(f"Unknown bundle format: {fmt}")
+        with tar:
+            for arcname, source in entries:
+                info = tarfile.TarInfo(arcname)
+                start = out.count
+                if source is None:
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(normalize_tarinfo(info))
+                    continue
+                elif isinstance(source, bytes):
+                    info.size = len(source)
+                    tar.addfile(normalize_tarinfo(info), io.BytesIO(source))
+                else:
+                    stat = os.stat(source)
+                    info.size = stat.st_size
+                    info.mode = stat.st_mode & 0o777
+                    with open(source, "rb") as f:
+                        tar.addfile(normalize_tarinfo(info), f)
+                sizes.append([arcname[2:], info.size, out.count - start])
+
+    #: Whatever the codec flushed when closed is spread over the files by size
+    pending = out.count - sum(compressed for path, size, compressed in sizes)
+    total = sum(size for path, size, compressed in sizes) or 1
+    for entry in sizes:
+        entry[2] += pending * entry[1] // total
+    return sizes
+
+
+def write_tree(path: str, entries):
+    """Write the bundle entries to a directory instead of an archive"""
+    if exists(path):
+        shutil.rmtree(path)
+    for arcname, source in entries:
+        dst = os.path.normpath(join(path, arcname))
+        if source is None:
+            os.makedirs(dst, exist_ok=True)
+            continue
+        if isinstance(source, bytes):
+            with open(dst, "wb") as f:
+                f.write(source)
+        else:
+            shutil.copy(source, dst)
+        os.utime(dst, (BUNDLE_MTIME, BUNDLE_MTIME))
+
+
+def replace_if_changed(src: str, dst: str) -> bool:
+    """Move src to dst unless dst already has the same contents, in which
+    case src is removed and dst is left untouched (keeping it's mtime).
+    Returns True if dst was replaced.
+
+    """
+    if exists(dst) and file_digest(src) == file_digest(dst):
+        os.remove(src)
+        return False
+    os.replace(src, dst)
+    return True
+
+
+def strip_enabled(args, env: dict) -> bool:
+    """Native libs are stripped if --strip is given or for release builds if
+    strip is set in the bundle options
+
+    """
+    if getattr(args, "strip", False):
+        return True
+    return getattr(args, "release", False) and env["bundle"].get("strip", False)
+
+
+def find_strip_tool(env: dict, target: str) -> list:
+    """Return the command used to strip the native libs of the target. This
+    is the strip_tool from the bundle options if set, otherwise the NDK's
+    llvm-strip on android and strip on iOS.
+
+    """
+    tool = env["bundle"].get("strip_tool")
+    if tool:
+        return tool.split()
+    if not target.startswith("android"):
+        return ["xcrun", "strip", "-x"]
+    ndk = expanduser(env["ndk"])
+    tools = glob(f"{ndk}/toolchains/llvm/prebuilt/*/bin/llvm-strip*")
+    if not tools:
+        raise EnvironmentError(
+            f"Couldn't find llvm-strip in {ndk}, set the bundle strip_tool option"
+        )
+    return [tools[0], "--strip-unneeded"]
+
+
+def strip_lib(cmd: list, src: str, dst: str, cache_dir: str) -> bool:
+    """Strip the src lib to dst. Stripped libs are cached by the hash of the
+    src and strip options so each is only stripped once. Returns True if it
+    was not in the cache.
+
+    """
+    m = hashlib.sha256(file_digest(src).encode())
+    m.update(" ".join(cmd[1:]).encode())
+    cached = join(cache_dir, m.hexdigest() + os.path.splitext(src)[-1])
+    stripped = not exists(cached)
+    if stripped:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}.{threading.get_ident()}"
+        sh.Command(cmd[0])(*cmd[1:], "-o", tmp, src)
+        os.replace(tmp, cached)
+    copy_file(cached, dst, "copy")
+    return stripped
+
+
+def strip_libs(cmd: list, libs: list, cache_dir: str = STRIP_CACHE_DIR) -> tuple:
+    """Strip each (src, dst) pair in libs concurrently and print a summary of
+    the sizes. Returns a tuple of the total size before and after.
+
+    """
+    if not libs:
+        return 0, 0
+    print_color(Colors.CYAN, f"[DEBUG] Stripping {len(libs)} native libs...")
+    with ThreadPoolExecutor() as pool:
+        strip = partial(strip_lib, cmd, cache_dir=cache_dir)
+        results = list(pool.map(strip, *zip(*libs)))
+    before = sum(os.path.getsize(src) for src, dst in libs)
+    after = sum(os.path.getsize(dst) for src, dst in libs)
+    print_color(
+        Colors.CYAN,
+        f"[DEBUG] {sum(results)} stripped, {len(libs) - sum(results)} from cache, "
+        f"{format_size(before)} -> {format_size(after)} "
+        f"({format_size(before - after)} saved)",
+    )
+    return before, after
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """Write the content to the path unless it already has it so it's mtime
+    is left untouched. Returns True if the file was written.
+
+    """
+    if exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    with open(path, "w") as f:
+        f.write(content)
+    return True
+
+
+def hash_tree(m, path: str):
+    """Update the hash with the relative path, size and mtime of every file
+    in the path
+
+    """
+    for dirpath, dirnames, filenames in sorted(os.walk(path, followlinks=True)):
+        for f in sorted(filenames):
+            stat = os.stat(join(dirpath, f))
+            rel = os.path.relpath(join(dirpath, f), path)
+            m.update(f"{rel}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+
+
+def write_archive(bundle: str, entries, fmt: str = "gz", level=None, threads: int = 0):
+    """Write the bundle archive removing any old ones in the same directory.
+    If it's the same as the existing archive that one is left untouched.
+    Returns the file sizes from write_bundle.
+
+    """
+    #: Remove old
+    name = os.path.basename(bundle).rpartition(f".{BUNDLE_FORMATS[fmt]}")[0]
+    for ext in BUNDLE_EXTENSIONS:
+        old = join(dirname(bundle), f"{name}.{ext}")
+        if ext != BUNDLE_FORMATS[fmt] and exists(old):
+            os.remove(old)
+
+    print_color(Colors.CYAN, f"[DEBUG] Creating python bundle {bundle}...")
+    sizes = write_bundle(f"{bundle}.tmp", entries, fmt, level, threads)
+    if not replace_if_changed(f"{bundle}.tmp", bundle):
+        print_color(Colors.CYAN, f"[DEBUG] {bundle} is unchanged")
+    return sizes
+
+
+def stream_bundle(
+    sources: dict,
+    bundle: str = "",
+    tree: str = "",
+    compile: bool = True,
+    jobs: int = 0,
+    pyc_cache: str = "",
+    fmt: str = "gz",
+    level=None,
+    threads: int = 0,
+    optimize: int = 0,
+    invalidation: str = "timestamp",
+    enaml: bool = False,
+    strip_enaml: bool = False,
+    zipimport: bool = False,
+    report=None,
+) -> "BundleReport":
+    """Compile the sources in memory and write them straight into the bundle
+    archive without staging a copy in the build dir. If a tree is given the
+    files are also written into that directory. Returns the BundleReport
+    (a new one if none is given).
+
+    If enaml is True the enaml files are compiled too and if strip_enaml is
+    also set their sources are left out of the bundle. If zipimport is True
+    each pyc replaces it's source instead of going in __pycache__ as that is
+    the only layout zipimport can load.
+
+    """
+    if report is None:
+        report = BundleReport()
+    report.bundle = bundle
+    report.layers = {"python": bundle or tree}
+    files = dict(sources)
+    if compile:
+        print_color(Colors.CYAN, "[DEBUG] Compiling py to pyc...")
+        exts = (".py", ".enaml") if enaml else (".py",)
+        py_files = [p for p in sources if p.endswith(exts)]
+        with report.timed("compile"):
+            compiled, cached, failed, pycs = compile_sources(
+                [sources[p] for p in py_files],
+                jobs=jobs,
+                cache_dir=pyc_cache,
+                dfiles=py_files,
+                optimize=optimize,
+                invalidation=invalidation,
+            )
+        print_color(
+            Colors.CYAN,
+            f"[DEBUG] {compiled} compiled, {cached} from cache, "
+            f"{len(failed)} failed",
+        )
+        for path in py_files:
+            cfile = bytecode_path(path, optimize)
+            if cfile not in pycs:
+                continue  # Failed so the source is used
+            if zipimport and path.endswith(".py"):
+                del files[path]
+                files[f"{path}c"] = pycs[cfile]
+                continue
+            files[cfile] = pycs[cfile]
+            if strip_enaml and path.endswith(".enaml"):
+                del files[path]
+
+    with report.timed("archive"):
+        if bundle:
+            report.files = write_archive(
+                bundle, iter_bundle_entries(files), fmt, level, threads
+            )
+        if tree:
+            print_color(Colors.CYAN, f"[DEBUG] Writing python bundle to {tree}...")
+            write_tree(tree, iter_bundle_entries(files))
+    if not bundle:
+        #: Files written to a tree are not compressed
+        for path, src in sorted(files.items()):
+            size = len(src) if isinstance(src, bytes) else os.path.getsize(src)
+            report.files.append([path, size, size])
+    return report
+
+
+#: Layers of a split bundle. The runtime layer is the sysroot's python tree
+#: and the app layer is everything else.
+BUNDLE_LAYERS = ["runtime", "app"]
+
+
+def bundle_layer(path: str) -> str:
+    """Return the layer of a split bundle the path belongs in"""
+    return "runtime" if path.startswith("python/") else "app"
+
+
+def read_layer_info(bundle: str) -> dict:
+    """Read the key and file sizes saved with a layer's bundle. Returns an
+    empty dict if the bundle or info is missing.
+
+    """
+    try:
+        with open(f"{bundle}.json") as f:
+            info = json.load(f)
+        return info if exists(bundle) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def stream_split_bundle(
+    sources: dict, path: str, key: str, fmt: str = "gz", report=None, **options
+) -> "BundleReport":
+    """Stream the sources into a runtime and an app layer bundle in the path
+    (see BUNDLE_LAYERS). The runtime layer is only rebuilt if the key it was
+    built with changed. Returns the BundleReport with the sizes of both.
+
+    """
+    if report is None:
+        report = BundleReport()
+    layers: dict = {layer: {} for layer in BUNDLE_LAYERS}
+    for p, src in sources.items():
+        layers[bundle_layer(p)][p] = src
+
+    ext = BUNDLE_FORMATS[fmt]
+    runtime = join(path, f"python-runtime.{ext}")
+    info = read_layer_info(runtime)
+    if info.get("key") == key:
+        print_color(Colors.CYAN, f"[DEBUG] {runtime} is up to date")
+        runtime_files = info["files"]
+    else:
+        stream_bundle(layers["runtime"], runtime, fmt=fmt, report=report, **options)
+        runtime_files = list(report.files)
+        with open(f"{runtime}.json", "w") as f:
+            json.dump(dict(key=key, files=runtime_files), f)
+
+    app = join(path, f"python-app.{ext}")
+    stream_bundle(layers["app"], app, fmt=fmt, report=report, **options)
+    report.files = runtime_files + list(report.files)
+    report.layers = {"runtime": runtime, "app": app}
+    return report
+
+
+#: Modules that are imported dynamically by the interpreter itself and must
+#: never be removed when tree shaking
+SHAKE_KEEP = [
+    "__future__",
+    "_collections_abc",
+    "_sitebuiltins",
+    "_sysconfigdata*",
+    "abc",
+    "codecs",
+    "encodings",
+    "encodings.*",
+    "genericpath",
+    "importlib",
+    "importlib.*",
+    "io",
+    "linecache",
+    "os",
+    "posixpath",
+    "runpy",
+    "site",
+    "sitecustomize",
+    "stat",
+    "traceback",
+    "usercustomize",
+    "zipimport",
+]
+
+#: Matches import statements in an enaml (or python) source file including
+#: those in enaml handlers (eg `clicked :: import x`)
+IMPORT_RE = re.compile(
+    r"(?:^|::|;)\s*(?:from\s+(\.*[\w.]*)\s+import\s+(\([^)]*\)|[^\n#;]+)"
+    r"|import\s+([\w.]+(?:\s+as\s+\w+)?(?:\s*,\s*[\w.]+(?:\s+as\s+\w+)?)*))",
+    re.MULTILINE,
+)
+
+
+def find_module_roots(paths) -> list:
+    """Find the directories of the bundle that are on the python path. These
+    are the bundle root, python/ and any site-packages, lib-dynload or
+    lib/pythonX.Y dirs. Returned with the most specific first.
+
+    """
+    roots = {"", "python"}
+    for path in paths:
+        parts = path.split("/")
+        for i, part in enumerate(parts[:-1]):
+            if re.match(r"(site-packages|lib-dynload|python\d\.\d+)$", part):
+                roots.add("/".join(parts[: i + 1]))
+    return sorted(roots, key=len, reverse=True)
+
+
+def module_name(path: str, roots: list) -> str:
+    """Return the python module name of the bundle path or an empty string if
+    it is not a module.
+
+    """
+    name, ext = os.path.splitext(path)
+    if ext == ".so":
+        head, sep, tail = name.rpartition("/")
+        name = head + sep + tail.split(".")[0]  # Strip any abi tag
+    elif ext not in (".py", ".enaml"):
+        return ""
+    for root in roots:
+        if not root:
+            break
+        if name.startswith(f"{root}/"):
+            name = name.partition(f"{root}/")[2]
+            break
+    if name.endswith("/__init__"):
+        name = name[: -len("/__init__")]
+    if not name or "." in name or "-" in name:
+        return ""  # Not importable
+    return name.replace("/", ".")
+
+
+def find_imports(source: str, name: str, is_package: bool) -> set:
+    """Find the absolute names of all modules imported by the source of the
+    named module. Both python and enaml sources are supported.
+
+    """
+    package = name if is_package else name.rpartition(".")[0]
+    imports = set()
+
+    def resolve(module: str) -> str:
+        level = len(module) - len(module.lstrip("."))
+        if not level:
+            return module
+        base = package.split(".")
+        if level > 1:
+            base = base[: 1 - level]
+        return ".".join(base + [module[level:]] if module[level:] else base)
+
+    for m in IMPORT_RE.finditer(source):
+        if m.group(3):
+            for alias in m.group(3).split(","):
+                imports.add(alias.split()[0])
+            continue
+        module = resolve(m.group(1))
+        imports.add(module)
+        for alias in m.group(2).strip("()").split(","):
+            alias = alias.split()
+            if alias and alias[0] != "*":
+                imports.add(f"{module}.{alias[0]}" if module else alias[0])
+    return imports
+
+
+def find_reachable_modules(sources: dict, entry: list, keep: list) -> tuple:
+    """Statically follow the imports of the entry modules and any module
+    matching a glob pattern in keep.
+
+    Returns a tuple of the path of each module in the sources by name, the
+    names of the modules reached and the names of everything imported by
+    them (including modules that are not in the sources).
+
+    """
+    roots = find_module_roots(sources)
+    modules = {}
+    for path in sources:
+        name = module_name(path, roots)
+        if name and (name not in modules or path.endswith("__init__.py")):
+            modules[name] = path
+
+    keep_re = re.compile("|".join(fnmatch.translate(p) for p in keep) or "(?!)")
+    queue = [m for m in modules if m in entry or keep_re.match(m)]
+    reachable = set(queue)
+    imports = set()
+    while queue:
+        name = queue.pop()
+        path = modules[name]
+        if path.endswith(".so"):
+            continue  # Imports of native modules are unknown
+        with open(sources[path], encoding="utf-8", errors="ignore") as f:
+            source = f.read()
+        is_package = os.path.basename(path).startswith("__init__.")
+        for imported in find_imports(source, name, is_package):
+            parts = imported.split(".")
+            #: Importing a submodule imports each parent package
+            for i in range(1, len(parts) + 1):
+                parent = ".".join(parts[:i])
+                imports.add(parent)
+                if parent in modules and parent not in reachable:
+                    reachable.add(parent)
+                    queue.append(parent)
+    return modules, reachable, imports
+
+
+def shake_sources(sources: dict, entry: list, keep: list) -> tuple:
+    """Remove python modules that can't be reached by statically following the
+    imports of the entry modules. Any module matching a glob pattern in keep
+    (and everything it imports) is always included. Non-module files are
+    removed only if the package they belong to is removed.
+
+    Returns a tuple of the files kept and the paths removed.
+
+    """
+    roots = find_module_roots(sources)
+    modules, reachable, imports = find_reachable_modules(sources, entry, keep)
+
+    #: Map each package dir to the package name so data files can be removed
+    #: with the package
+    packages = {
+        dirname(path): name
+        for name, path in modules.items()
+        if os.path.basename(path).startswith("__init__.")
+    }
+    kept, removed = {}, []
+    for path, src in sources.items():
+        name = module_name(path, roots)
+        if not name:
+            #: Find the closest package containing the file
+            d = dirname(path)
+            while d and d not in packages:
+                d = dirname(d)
+            name = packages.get(d, "")
+        if not name or name in reachable:
+            kept[path] = src
+        else:
+            removed.append(path)
+    return kept, removed
+
+
+#: ELF layouts of 32 and 64 bit files by the class in the header. Each has
+#: the format and offset of e_phoff, the offset of e_phentsize, the format of
+#: a program header with the index of p_offset, p_vaddr and p_filesz in it
+#: and the format of a dynamic entry.
+ELF_LAYOUTS = {
+    1: ("I", 0x1C, 0x2A, "IIIIIIII", 1, 2, 4, "iI"),
+    2: ("Q", 0x20, 0x36, "IIQQQQQQ", 2, 3, 5, "qQ"),
+}
+
+
+def read_elf_needed(path: str) -> Optional[list]:
+    """Read the names of the shared libs an ELF file depends on (the
+    DT_NEEDED entries of it's PT_DYNAMIC segment). Program headers are used
+    so this also works for libs stripped of their section headers. Returns
+    None if the file can't be parsed, the caller must then assume it may
+    need anything.
+
+    """
+    PT_LOAD, PT_DYNAMIC = 1, 2
+    DT_NULL, DT_NEEDED, DT_STRTAB = 0, 1, 5
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"\x7fELF" or len(data) < 6 or data[4] not in ELF_LAYOUTS:
+        return None
+    layout = ELF_LAYOUTS[data[4]]
+    phoff_fmt, phoff_offset, phent_offset, phdr = layout[:4]
+    p_offset, p_vaddr, p_filesz, dyn_fmt = layout[4:]
+    order = ">" if data[5] == 2 else "<"
+    try:
+        (phoff,) = struct.unpack_from(order + phoff_fmt, data, phoff_offset)
+        phentsize, phnum = struct.unpack_from(order + "HH", data, phent_offset)
+        headers = [
+            struct.unpack_from(order + phdr, data, phoff + i * phentsize)
+            for i in range(phnum)
+        ]
+        dynamic = [h for h in headers if h[0] == PT_DYNAMIC]
+        if not dynamic:
+            #: Statically linked
+            return []
+        dyn = struct.Struct(order + dyn_fmt)
+        offset, size = dynamic[0][p_offset], dynamic[0][p_filesz]
+        entries = []
+        for i in range(offset, offset + size, dyn.size):
+            tag, value = dyn.unpack_from(data, i)
+            if tag == DT_NULL:
+                break
+            entries.append((tag, value))
+
+        #: DT_STRTAB is an address, map it to the file through the PT_LOAD
+        #: segment it falls in
+        (strtab_addr,) = [value for tag, value in entries if tag == DT_STRTAB]
+        strtab = None
+        for h in headers:
+            if h[0] == PT_LOAD and 0 <= strtab_addr - h[p_vaddr] < h[p_filesz]:
+                strtab = strtab_addr - h[p_vaddr] + h[p_offset]
+                break
+        if strtab is None:
+            return None
+        needed = []
+        for tag, value in entries:
+            if tag == DT_NEEDED:
+                start = strtab + value
+                end = data.index(b"\0", start)
+                needed.append(data[start:end].decode())
+    except (struct.error, IndexError, ValueError):
+        return None
+    return needed
+
+
+def find_reachable_libs(libs: dict, roots) -> set:
+    """Follow the DT_NEEDED entries of the root libs. The libs map the name
+    of each lib to it's path. Returns the names of every lib reached. If a
+    reached lib can't be parsed every lib is kept.
+
+    """
+    queue = [name for name in roots if name in libs]
+    reachable = set(queue)
+    while queue:
+        needed = read_elf_needed(libs[queue.pop()])
+        if needed is None:
+            return set(libs)
+        for name in needed:
+            if name in libs and name not in reachable:
+                reachable.add(name)
+                queue.append(name)
+    return reachable
+
+
+def read_entry_point_modules(site_packages: str) -> set:
+    """Read the module names referenced by every entry point declared by the
+    distributions installed in the site-packages dir.
+
+    """
+    modules = set()
+    for ep_file in glob(join(site_packages, "*-info", "entry_points.txt")):
+        config = configparser.ConfigParser(delimiters=("=",), interpolation=None)
+        config.optionxform = str  # type: ignore
+        try:
+            config.read(ep_file)
+        except configparser.Error:
+            continue
+        for section in config.sections():
+            for value in config[section].values():
+                module = value.split(":")[0].split("[")[0].strip()
+                if module:
+                    modules.add(module)
+    return modules
+
+
+class BundleManifest(Atom):
+    """Records what was copied to the bundle build dir so the next bundle
+    only needs to update the files that changed.
+
+    """
+
+    #: Path the manifest is saved to
+    path = Str()
+
+    #: Settings that affect every file in the build (exclusions, compile
+    #: flags, etc..). If any change the bundle must be fully rebuilt.
+    config = Dict()
+
+    #: Maps each path in the build to the [size, mtime, sha256] of the
+    #: source it was copied from
+    files = Dict()
+
+    #: Format and level of the last archive created from the build
+    archive = Dict()
+
+    #: File sizes of the last archive created (see write_bundle)
+    sizes = List()
+
+    def load(self) -> bool:
+        """Load the saved manifest. Returns False if it is missing or invalid."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data["version"] != BUNDLE_MANIFEST_VERSION:
+                return False
+            self.config = data["config"]
+            self.files = data["files"]
+            self.archive = data["archive"]
+            self.sizes = data["sizes"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save(self):
+        """Save the manifest atomically"""
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            data = dict(
+                version=BUNDLE_MANIFEST_VERSION,
+                config=self.config,
+                files=self.files,
+                archive=self.archive,
+                sizes=self.sizes,
+            )
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def invalidate(self):
+        """Remove the saved manifest"""
+        if exists(self.path):
+            os.remove(self.path)
+
+
+#: Version of the saved bundle report
+BUNDLE_REPORT_VERSION = 2
+
+#: Stages of a bundle build in the order they run
+BUNDLE_STAGES = ["exclude", "copy", "compile", "archive", "assets"]
+
+
+def bundle_package(path: str, roots: list) -> str:
+    """Return the top level package or module a bundle path belongs to"""
+    for root in roots:
+        if root and path.startswith(f"{root}/"):
+            path = path.replace(f"{root}/", "", 1)
+            break
+    parts = path.split("/")
+    if len(parts) == 1 or parts[0] == "__pycache__":
+        #: A module (or it's pyc) so strip the extension and any abi tag
+        return parts[-1].split(".")[0]
+    return parts[0]
+
+
+def format_size(size: float) -> str:
+    """Format a number of bytes for display"""
+    for unit in ["B", "KB", "MB"]:
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def tree_size(path: str) -> int:
+    """Total size of all files in the path"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        for f in filenames:
+            size += os.path.getsize(join(dirpath, f))
+    return size
+
+
+class BundleReport(Atom):
+    """Sizes and stage timings of a bundle build. Each build saves one next to
+    the bundle so the next can show what changed.
+
+    """
+
+    #: Target the bundle was built for
+    target = Str()
+
+    #: Path of the bundle archive
+    bundle = Str()
+
+    #: Maps each layer to the path of it's bundle. Only split bundles have
+    #: more than one.
+    layers = Dict()
+
+    #: Wall time in seconds of each of the BUNDLE_STAGES
+    stages = Dict()
+
+    #: The [path, size, compressed size] of each file in the bundle
+    files = List()
+
+    #: Bytes skipped by the excluded patterns
+    excluded = Int()
+
+    #: Bytes removed by tree shaking
+    shaken = Int()
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Add the time spent in the block to the stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[stage] = self.stages.get(stage, 0) + elapsed
+
+    def packages(self) -> dict:
+        """Group the files by top level package. Returns a dict of the
+        [files, size, compressed size] of each package.
+
+        """
+        roots = find_module_roots(path for path, size, compressed in self.files)
+        packages: dict = {}
+        for path, size, compressed in self.files:
+            stats = packages.setdefault(bundle_package(path, roots), [0, 0, 0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += compressed
+        return packages
+
+    @classmethod
+    def load(cls, path: str):
+        """Load a saved report. Returns None if it is missing or invalid."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.pop("version") != BUNDLE_REPORT_VERSION:
+                return None
+            return cls(**data)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path: str):
+        """Save the report as json"""
+        with open(path, "w") as f:
+            data = dict(
+                version=BUNDLE_REPORT_VERSION,
+                target=self.target,
+                bundle=self.bundle,
+                layers=self.layers,
+                stages=self.stages,
+                excluded=self.excluded,
+                shaken=self.shaken,
+                files=self.files,
+            )
+            json.dump(data, f, indent=2)
+
+    def print_summary(self, previous=None, limit: int = 15):
+        """Print a table of the largest packages and the stage times. If a
+        previous report is given the changes are shown and any package whose
+        compressed size changed is highlighted.
+
+        """
+        packages = self.packages()
+        old = previous.packages() if previous else None
+        print_color(Colors.BOLD, f"[INFO] Bundle report for {self.target}")
+        print_color(
+            Colors.BOLD,
+            f"  {'Package':<30}{'Files':>8}{'Size':>12}{'Compressed':>12}"
+            f"{'Change':>12}",
+        )
+        ranked = sorted(packages.items(), key=lambda it: it[1][2], reverse=True)
+        if old is not None:
+            ranked.extend(
+                (name, [0, 0, 0]) for name in sorted(old) if name not in packages
+            )
+        shown = 0
+        for i, (name, stats) in enumerate(ranked):
+            before = None if old is None else old.get(name, [0, 0, 0])
+            #: Always list packages that changed even if they are small
+            if i < limit or (before is not None and before[2] != stats[2]):
+                self.print_row(name, stats, before)
+                shown += 1
+        if shown < len(ranked):
+            print(f"  ... and {len(ranked) - shown} more")
+        total = [sum(stats[i] for stats in packages.values()) for i in range(3)]
+        before = None
+        if old is not None:
+            before = [sum(stats[i] for stats in old.values()) for i in range(3)]
+        self.print_row("Total", total, before)
+        if self.excluded:
+            print(f"  {'Excluded':<38}{format_size(self.excluded):>12}")
+        if self.shaken:
+            print(f"  {'Tree shaken':<38}{format_size(self.shaken):>12}")
+
+        print_color(Colors.BOLD, f"  {'Stage':<30}{'Time':>8}{'Change':>12}")
+        stages = [(s, self.stages[s]) for s in BUNDLE_STAGES if s in self.stages]
+        stages.append(("total", sum(self.stages.values())))
+        for stage, elapsed in stages:
+            change = ""
+            if previous and (stage == "total" or stage in previous.stages):
+                if stage == "total":
+                    change = f"{elapsed - sum(previous.stages.values()):+.2f}s"
+                else:
+                    change = f"{elapsed - previous.stages[stage]:+.2f}s"
+            print(f"  {stage:<30}{elapsed:>7.2f}s{change:>12}")
+
+    def print_row(self, name: str, stats: list, before=None):
+        """Print a package row colored if the compressed size changed"""
+        count, size, compressed = stats
+        change = ""
+        if before is not None:
+            diff = compressed - before[2]
+            change = f"+{format_size(diff)}" if diff > 0 else format_size(diff)
+        row = (
+            f"  {name:<30}{count:>8}{format_size(size):>12}"
+            f"{format_size(compressed):>12}{change:>12}"
+        )
+        if before is None or compressed == before[2]:
+            print(row)
+        else:
+            print_color(Colors.RED if compressed > before[2] else Colors.GREEN, row)
 
 
 class Command(Atom):
@@ -268,6 +2060,9 @@ class Create(Command):
     app_env_required = False
 
     def run(self, args):
+        from cookiecutter.log import configure_logger
+        from cookiecutter.main import cookiecutter
+
         template = join(dirname(__file__), "templates", args.what)
         configure_logger(
             stream_level="DEBUG" if args.verbose else "INFO",
@@ -440,6 +2235,25 @@ class MakePipRecipe(Command):
             print_color(Colors.GREEN, f"[INFO] Built {dst} successfully!")
 
 
+def ndk_symbols_dir(app_src: str, arch: str, per_abi: bool = False) -> str:
+    """Return the dir with the unstripped libs of the arch that ndk-stack
+    reads. Builds with ndk-build --per-abi use a separate obj dir per ABI.
+
+    """
+    if per_abi:
+        return f"{app_src}/obj/{arch}/local/{arch}"
+    return f"{app_src}/obj/local/{arch}"
+
+
+def ndk_built_per_abi(env: dict) -> bool:
+    """Return if the last ndk-build used --per-abi as saved in it's stamp"""
+    try:
+        with open(join(env["python_build_dir"], "ndk-build.json")) as f:
+            return json.load(f).get("per_abi", False)
+    except (OSError, ValueError):
+        return False
+
+
 class NdkStack(Command):
     """Shortcut to run ndk-stack to show debugging output of a crash in a
     native library.
@@ -464,7 +2278,10 @@ class NdkStack(Command):
             )
         )
         arch = args.arch if args else "armeabi-v7a"
-        sym = f"venv/android/enaml-native/src/main/obj/local/{arch}"
+
+        #: Use the obj layout of the last ndk-build
+        app_src = "venv/android/enaml-native/src/main"
+        sym = ndk_symbols_dir(app_src, arch, ndk_built_per_abi(env))
         shprint(ndk_stack, sh.adb("logcat", _piped=True), "-sym", sym)
 
 
@@ -475,16 +2292,59 @@ class NdkBuild(Command):
 
     title = "ndk-build"
     help = "Run ndk-build on the android project"
+    args = [
+        (
+            "--force",
+            dict(
+                action="store_true",
+                help="Run ndk-build even if nothing changed since the last build",
+            ),
+        ),
+        (
+            "-j --jobs",
+            dict(
+                type=int,
+                default=0,
+                help="Number of jobs ndk-build runs at once (default is the "
+                "cpu count)",
+            ),
+        ),
+        (
+            "--per-abi",
+            dict(
+                action="store_true",
+                help="Build each ABI with a separate ndk-build process concurrently",
+            ),
+        ),
+        (
+            "--release",
+            dict(
+                action="store_true",
+                help="Strip the python native libs if strip is set in the bundle "
+                "options",
+            ),
+        ),
+        ("--strip", dict(action="store_true", help="Strip the python native libs")),
+        (
+            "--unused-libs",
+            dict(
+                choices=["report", "exclude"],
+                help="Report or exclude native libs that can't be reached from "
+                "the app's imports",
+            ),
+        ),
+    ]
 
     def run(self, args=None):
         ctx = self.ctx
         env = ctx["android"]
         # Lib version
-        for line in self.cli.conda("list").split("\n"):
-            print(line)
-            if "android-python" in line:
-                py_version = ".".join(line.split()[1].split(".")[:2])
-                break
+        version = conda_package_version("android-python", env["conda_prefix"])
+        if not version:
+            raise EnvironmentError(
+                "android-python is not installed in {conda_prefix}".format(**env)
+            )
+        py_version = ".".join(version.split(".")[:2])
 
         print_color(Colors.GREEN, f"[DEBUG] Building for {py_version}")
 
@@ -523,8 +2383,8 @@ class NdkBuild(Command):
                     line = f"APP_ABI := {app_abi}"
                 new_mk.append(line)
 
-            with open("Application.mk", "w") as f:
-                f.write("\n".join(new_mk))
+            app_mk = "\n".join(new_mk)
+            write_if_changed("Application.mk", app_mk)
 
             #: Patch Android.mk to have the correct python version
             with open("Android.mk") as f:
@@ -537,11 +2397,47 @@ class NdkBuild(Command):
                     line = f"PY_LIB_VER := {py_version}"
                 new_mk.append(line)
 
-            with open("Android.mk", "w") as f:
-                f.write("\n".join(new_mk))
-
-            #: Now run nkd-build
-            shprint(ndk_build)
+            android_mk = "\n".join(new_mk)
+            write_if_changed("Android.mk", android_mk)
+
+            #: Skip ndk-build if the inputs and outputs are the same as the
+            #: last build
+            state = dict(
+                abis=arches,
+                py_version=py_version,
+                ndk=env["ndk"],
+                mk=[app_mk, android_mk],
+                packages=sorted(
+                    "{name}-{version}-{build}".format(**p)
+                    for p in conda_packages(conda_prefix).values()
+                ),
+            )
+            m = hashlib.sha256(json.dumps(state, sort_keys=True).encode())
+            hash_tree(m, jni_dir)
+            key = m.hexdigest()
+            stamp = join(env["python_build_dir"], "ndk-build.json")
+            try:
+                with open(stamp) as f:
+                    last = json.load(f)
+            except (OSError, ValueError):
+                last = {}
+            force = args is not None and getattr(args, "force", False)
+            outputs = self.outputs(ndk_build_dir, arches)
+            #: The obj layout of the last build is kept when it's skipped
+            per_abi = last.get("per_abi", False)
+            if not force and [last.get("key"), last.get("outputs")] == [key, outputs]:
+                print_color(Colors.CYAN, "[DEBUG] ndk-build is up to date")
+            else:
+                #: Invalidate until the build completes
+                if exists(stamp):
+                    os.remove(stamp)
+                #: Now run nkd-build
+                jobs = (args and getattr(args, "jobs", 0)) or os.cpu_count() or 1
+                per_abi = args is not None and getattr(args, "per_abi", False)
+                if per_abi:
+                    self.build_per_abi(ndk_build, arches, app_src, ndk_build_dir, jobs)
+                else:
+                    shprint(ndk_build, f"-j{jobs}")
 
         #: Add entry point so packages can include their own jni libs
         dependencies = ctx["dependencies"]  # .keys()
@@ -557,27 +2453,106 @@ class NdkBuild(Command):
 
         #: Now copy all compiled python modules to the jniLibs dir so android
         #: includes them
-        for arch in arches:
-            cfg = dict(
-                arch=arch,
-                local_arch=ANDROID_ABIS[arch],
-                ndk_build_dir=ndk_build_dir,
-            )
-            cfg.update(env)  # get python_build_dir from the env
+        excluded = compile_excluded(tuple(env.get("excluded", [])))
+        strip = strip_enabled(args, env)
+        unused_libs = getattr(args, "unused_libs", None) or env["bundle"].get(
+            "unused_libs"
+        )
+        root = abspath(os.getcwd())
 
+        def collect(arch: str) -> list:
             #: Where .so files go
-            dst = abspath(f"{ndk_build_dir}/{arch}".format(**cfg))
+            dst = abspath(f"{ndk_build_dir}/{arch}")
+            src = "{conda_prefix}/android/{local_arch}/lib".format(
+                local_arch=ANDROID_ABIS[arch], **env
+            )
+            #: Where ndk-stack looks for symbols
+            symbols = ndk_symbols_dir(app_src, arch, per_abi)
+
+            #: Collect all .so files to the lib dir, skipping unchanged ones
+            os.makedirs(dst, exist_ok=True)
+            if strip:
+                os.makedirs(symbols, exist_ok=True)
+            found = {}
+            for lib in glob(f"{src}/*.so"):
+                name = os.path.basename(lib)
+                if not excluded.match(name):
+                    found[name] = lib
+
+            if unused_libs:
+                libs = {os.path.basename(lib): lib for lib in glob(f"{dst}/*.so")}
+                libs.update(found)
+                cmd = self.cmds["bundle-assets"]
+                unused = cmd.find_unused_libs(env, arch, libs, root)
+                size = sum(os.path.getsize(libs[name]) for name in unused)
+                print_color(
+                    Colors.CYAN,
+                    f"[DEBUG] {len(unused)} native libs can't be reached for "
+                    f"{arch} ({format_size(size)}): {', '.join(unused)}",
+                )
+                if unused_libs == "exclude":
+                    for name in unused:
+                        found.pop(name, None)
+                        if exists(join(dst, name)):
+                            os.remove(join(dst, name))
+
+            stripped = []
+            for name, lib in found.items():
+                if strip:
+                    #: Keep the unstripped lib
+                    copy_file(lib, join(symbols, name), "copy")
+                    stripped.append((lib, join(dst, name)))
+                else:
+                    copy_file(lib, join(dst, name), "copy")
+            return stripped
+
+        with ThreadPoolExecutor() as pool:
+            libs = [lib for found in pool.map(collect, arches) for lib in found]
+        if strip:
+            strip_libs(find_strip_tool(env, "android"), libs)
+
+        os.makedirs(dirname(stamp), exist_ok=True)
+        with open(stamp, "w") as f:
+            outputs = self.outputs(ndk_build_dir, arches)
+            json.dump(dict(key=key, outputs=outputs, per_abi=per_abi), f)
+
+    def build_per_abi(
+        self, ndk_build, arches: list, app_src: str, ndk_build_dir: str, jobs: int
+    ):
+        """Run a separate ndk-build for each ABI concurrently. Each writes to
+        it's own obj/<abi> dir and the libs are then copied into the
+        ndk_build_dir. The output of each is prefixed with the ABI.
 
-            #: Collect all .so files to the lib dir
-            with cd("{conda_prefix}/android/" "{local_arch}/lib/".format(**cfg)):
+        """
+        commands = []
+        for arch in arches:
+            out = f"{app_src}/obj/{arch}"
+            args = [
+                ndk_build,
+                f"-j{max(1, jobs // len(arches))}",
+                f"APP_ABI={arch}",
+                f"NDK_OUT={out}",
+                f"NDK_LIBS_OUT={out}/libs",
+            ]
+            commands.append((arch, args))
 
-                for lib in glob("*.so"):
-                    excluded = [
-                        p for p in env.get("excluded", []) if fnmatch.fnmatch(lib, p)
-                    ]
-                    if excluded:
-                        continue
-                    shutil.copy(lib, dst)
+        print_color(
+            Colors.CYAN, f"[INFO ] running {len(arches)} ndk-builds concurrently"
+        )
+        run_commands(commands, jobs=len(arches))
+        for arch in arches:
+            out = f"{app_src}/obj/{arch}"
+            cp(f"{out}/libs/{arch}", f"{ndk_build_dir}/{arch}", "copy")
+
+    def outputs(self, ndk_build_dir: str, arches: list) -> str:
+        """Hash the libs in the output dir of each arch"""
+        m = hashlib.sha256()
+        for arch in arches:
+            path = join(ndk_build_dir, arch)
+            if not exists(path):
+                return ""
+            hash_tree(m, path)
+        return m.hexdigest()
 
 
 class BundleAssets(Command):
@@ -587,17 +2562,129 @@ class BundleAssets(Command):
     help = "Creates a python bundle of all .py and .enaml files"
     args = [
         (
-            "target",
+            "target",
+            dict(
+                nargs="?",
+                default="android",
+                help="Build for the given target (android, iphoneos, iphonesimulator)",
+            ),
+        ),
+        ("--release", dict(action="store_true", help="Create a release bundle")),
+        (
+            "--no-compile",
+            dict(action="store_true", help="Don't generate python cache"),
+        ),
+        (
+            "--incremental",
+            dict(
+                action="store_true",
+                help="Only update files that changed since the last bundle",
+            ),
+        ),
+        (
+            "--all",
+            dict(
+                action="store_true",
+                help="Bundle every configured android ABI and iOS target "
+                "concurrently (always streams)",
+            ),
+        ),
+        (
+            "--stream",
+            dict(
+                action="store_true",
+                help="Write the bundle directly from the sources without "
+                "staging a copy in the build dir",
+            ),
+        ),
+        (
+            "--shake",
+            dict(
+                action="store_true",
+                help="Remove modules that are not imported by the app",
+            ),
+        ),
+        (
+            "--split",
+            dict(
+                action="store_true",
+                help="Split the bundle into a runtime layer that is only rebuilt "
+                "when the env changes and an app layer",
+            ),
+        ),
+        (
+            "--zipimport",
+            dict(
+                action="store_true",
+                help="Create a zip the app can import from without extracting "
+                "it. Extension modules are installed as native libs.",
+            ),
+        ),
+        (
+            "--strip",
+            dict(
+                action="store_true",
+                help="Strip the native libs (default for release bundles if "
+                "strip is set in the bundle options)",
+            ),
+        ),
+        (
+            "--unused-libs",
             dict(
-                nargs="?",
-                default="android",
-                help="Build for the given target (android, iphoneos, iphonesimulator)",
+                choices=["report", "exclude"],
+                help="Report or exclude native libs that can't be reached from "
+                "the app's imports",
             ),
         ),
-        ("--release", dict(action="store_true", help="Create a release bundle")),
         (
-            "--no-compile",
-            dict(action="store_true", help="Don't generate python cache"),
+            "-j --jobs",
+            dict(
+                type=int,
+                default=0,
+                help="Number of processes used to compile (default is the cpu count)",
+            ),
+        ),
+        (
+            "--no-cache",
+            dict(action="store_true", help="Don't use the compiled python cache"),
+        ),
+        (
+            "--optimize",
+            dict(
+                type=int,
+                choices=[0, 1, 2],
+                help="Bytecode optimization level like python's -O and -OO "
+                "(default is 1 for release bundles, otherwise 0)",
+            ),
+        ),
+        (
+            "--invalidation",
+            dict(
+                choices=list(PYC_INVALIDATION_MODES),
+                help="How pycs are validated against their source (default "
+                "is unchecked-hash for release bundles, otherwise timestamp)",
+            ),
+        ),
+        (
+            "--format",
+            dict(
+                choices=list(BUNDLE_FORMATS),
+                help="Bundle archive format (default is gz). The app runtime "
+                "must support the format used.",
+            ),
+        ),
+        (
+            "--level",
+            dict(type=int, help="Compression level (default depends on format)"),
+        ),
+        (
+            "--threads",
+            dict(
+                type=int,
+                default=0,
+                help="Compression threads for formats that support it (zstd). "
+                "Default is the cpu count",
+            ),
         ),
     ]
 
@@ -613,31 +2700,92 @@ class BundleAssets(Command):
         else:
             env = ctx["ios"]
 
+        #: Archive format and compression level
+        zipimport = args.zipimport or env["bundle"].get("zipimport", False)
+        fmt = args.format or env["bundle"].get("format", "zip" if zipimport else "gz")
+        if fmt not in BUNDLE_FORMATS:
+            formats = ", ".join(BUNDLE_FORMATS)
+            raise ValueError(f"Bundle format must be one of {formats}")
+        if zipimport and fmt != "zip":
+            raise ValueError("zipimport bundles must use the zip format")
+        if zipimport and args.target != "android" and not args.all:
+            raise ValueError("zipimport bundles are only supported on android")
+        split = args.split or env["bundle"].get("split", False)
+        if split and args.target != "android" and not args.all:
+            raise ValueError("Split bundles are only supported on android")
+        level = env["bundle"].get("level") if args.level is None else args.level
+        threads = args.threads or env["bundle"].get("threads", 0)
+
+        #: Release bundles are optimized and use pycs that are never checked
+        #: against the source unless configured otherwise
+        optimize, invalidation = 0, "timestamp"
+        if args.release:
+            optimize = env["bundle"].get("optimize", 1)
+            invalidation = env["bundle"].get("invalidation", "unchecked-hash")
+        if args.optimize is not None:
+            optimize = args.optimize
+        invalidation = args.invalidation or invalidation
+        if optimize not in (0, 1, 2):
+            raise ValueError("Optimization level must be 0, 1 or 2")
+        if invalidation not in PYC_INVALIDATION_MODES:
+            modes = ", ".join(PYC_INVALIDATION_MODES)
+            raise ValueError(f"Pyc invalidation mode must be one of {modes}")
+
+        #: Precompile enaml files using the host's enaml if it's installed
+        enaml = env["bundle"].get("compile_enaml", True) and not args.no_compile
+        if enaml and importlib.util.find_spec("enaml") is None:
+            msg = "[WARNING] enaml is required to precompile .enaml files: Run 'pip install enaml'"
+            print_color(Colors.RED, msg)
+            enaml = False
+        strip_enaml = enaml and args.release and env["bundle"].get("strip_enaml", False)
+
         #: Now copy to android assets folder
         #: Extracted file type
-        bundle = "python.tar.gz"
+        bundle = f"python.{BUNDLE_FORMATS[fmt]}"
         root = abspath(os.getcwd())
 
+        jobs = args.jobs or env["bundle"].get("jobs", 0)
+        pyc_cache = expanduser(env["bundle"].get("pyc_cache", PYC_CACHE_DIR))
+        if args.no_cache:
+            pyc_cache = ""
+        options = dict(
+            compile=not args.no_compile,
+            jobs=jobs,
+            pyc_cache=pyc_cache,
+            fmt=fmt,
+            level=level,
+            threads=threads,
+            optimize=optimize,
+            invalidation=invalidation,
+            enaml=enaml,
+            strip_enaml=strip_enaml,
+        )
+
+        if args.all:
+            reports = self.bundle_all(args, root, bundle, options, zipimport, split)
+            android = [r for t, r in reports.items() if t.startswith("android")]
+            if android:
+                mode = "zipimport" if zipimport else "extract"
+                manifest = self.runtime_manifest(mode, options, android[0])
+                with android[0].timed("assets"):
+                    self.install_android_bundle(android[0], manifest)
+            ios = [r for t, r in reports.items() if not t.startswith("android")]
+            if ios:
+                #: The first iOS target is written to the assets as a tree
+                ios[0].layers = {"python": join(root, "ios/assets/python")}
+                manifest = self.runtime_manifest("tree", options, ios[0])
+                self.install_runtime_manifest("ios/assets/python", manifest)
+            for report in reports.values():
+                self.save_report(report, dirname(report.bundle))
+            print_color(Colors.GREEN, "[INFO] Python bundled successfully!")
+            return
+
         # Run lib build
         if args.target == "android":
             #: Um, we're passing args from another command?
             self.cmds["ndk-build"].run(args)
         else:
-            #: Collect all .so files to the lib dir
-            with cd("{conda_prefix}/{target}/lib/".format(target=args.target, **env)):
-                dst = f"{root}/ios/Libs"
-                if exists(dst):
-                    shutil.rmtree(dst)
-                os.makedirs(dst)
-
-                # Copy all libs to the
-                for lib in glob("*.dylib"):
-                    excluded = [
-                        p for p in env.get("excluded", []) if fnmatch.fnmatch(lib, p)
-                    ]
-                    if excluded:
-                        continue
-                    shutil.copy(lib, dst)
+            self.collect_ios_libs(env, args.target, root, strip_enabled(args, env))
 
         # Clean each arch
         #: Remove old
@@ -664,107 +2812,697 @@ class BundleAssets(Command):
             #     "Error: Python build doesn't exist. "
             #     "You should run './enaml-native build-python' first!")
 
-        with cd(env["python_build_dir"]):
+        excluded = env.get("excluded", []) + ["*.dist-info", "*.egg-info"]
+        #: The zipimport layout and split bundles are only supported when
+        #: streaming
+        stream = split or zipimport or args.stream or env["bundle"].get("stream")
+
+        python_build_dir = env["python_build_dir"]
+        report = BundleReport(target=cfg["target"])
+        with cd(python_build_dir):
+            print_color(Colors.CYAN, "[DEBUG] Collecting sources...")
+            with report.timed("exclude"):
+                sources = self.collect_sources(cfg, root, excluded, report)
+                sources = self.shake(sources, cfg, env["bundle"], args.shake, report)
+            if zipimport:
+                #: Extension modules can't be imported from a zip so they are
+                #: installed as native libs instead
+                sources = {p: s for p, s in sources.items() if not p.endswith(".so")}
+
+            if stream and args.target != "android":
+                #: iOS uses the files directly
+                tree = join(root, "ios/assets/python")
+                stream_bundle(sources, tree=tree, report=report, **options)
+            elif split:
+                key = self.runtime_key(cfg, excluded, sources, options, zipimport)
+                stream_split_bundle(
+                    sources,
+                    abspath("."),
+                    key,
+                    zipimport=zipimport,
+                    report=report,
+                    **options,
+                )
+            elif stream:
+                stream_bundle(
+                    sources,
+                    abspath(bundle),
+                    zipimport=zipimport,
+                    report=report,
+                    **options,
+                )
+            else:
+                incremental = args.incremental or env["bundle"].get(
+                    "incremental", False
+                )
+                config = dict(
+                    target=cfg["target"],
+                    excluded=sorted(excluded),
+                    compile=not args.no_compile,
+                    optimize=optimize,
+                    invalidation=invalidation,
+                    enaml=enaml,
+                    strip_enaml=strip_enaml,
+                )
+                self.stage_bundle(
+                    sources, bundle, config, incremental, report=report, **options
+                )
+
+        with report.timed("assets"):
+            # Copy to Android assets
+            if args.target == "android":
+                if zipimport:
+                    for arch in env["targets"]:
+                        self.install_native_libs(
+                            env, f"android/{arch}", excluded, strip_enabled(args, env)
+                        )
+                mode = "zipimport" if zipimport else "extract"
+                manifest = self.runtime_manifest(mode, options, report)
+                self.install_android_bundle(report, manifest)
+
+            # Copy to iOS assets
+            else:
+                if not stream:
+                    # TODO Use the bundle!
+                    mode = env["bundle"].get("copy", "auto")
+                    if mode not in COPY_MODES:
+                        raise ValueError(
+                            f"Invalid bundle copy mode {mode}, must be one of "
+                            f"{COPY_MODES}"
+                        )
+                    cp(f"{python_build_dir}/build", "ios/assets/python", mode)
+
+                    # cp('{python_build_dir}/{bundle}'.format(bundle=bundle, **env),
+                    #   'ios/app/src/main/assets/python/{bundle}'.format(bundle=bundle))
+                report.layers = {"python": join(root, "ios/assets/python")}
+                manifest = self.runtime_manifest("tree", options, report)
+                self.install_runtime_manifest("ios/assets/python", manifest)
+
+        self.save_report(report, python_build_dir)
+        print_color(Colors.GREEN, "[INFO] Python bundled successfully!")
+
+    def save_report(self, report: BundleReport, path: str):
+        """Print the bundle report compared to the last one saved in path for
+        the same target and save it in it's place
+
+        """
+        name = report.target.replace("/", "-")
+        filename = join(path, f"bundle-report-{name}.json")
+        previous = BundleReport.load(filename)
+        report.print_summary(previous)
+        report.save(filename)
+        print_color(Colors.CYAN, f"[DEBUG] Bundle report saved to {filename}")
+
+    def collect_ios_libs(self, env: dict, target: str, root: str, strip: bool = False):
+        """Collect all .dylib files of the target to the ios/Libs dir. If
+        strip is set they are stripped and the unstripped libs are kept in
+        `{python_build_dir}/{target}/symbols`.
+
+        """
+        with cd("{conda_prefix}/{target}/lib/".format(target=target, **env)):
+            dst = f"{root}/ios/Libs"
+            if exists(dst):
+                shutil.rmtree(dst)
+            os.makedirs(dst)
+
+            # Copy all libs to the
+            excluded = compile_excluded(tuple(env.get("excluded", [])))
+            libs = []
+            for lib in glob("*.dylib"):
+                if excluded.match(lib):
+                    continue
+                if strip:
+                    libs.append((abspath(lib), join(dst, lib)))
+                else:
+                    shutil.copy(lib, dst)
+            if libs:
+                #: Keep the unstripped libs
+                symbols = join(env["python_build_dir"], target, "symbols")
+                os.makedirs(symbols, exist_ok=True)
+                for lib, lib_dst in libs:
+                    copy_file(lib, join(symbols, os.path.basename(lib)), "copy")
+                strip_libs(find_strip_tool(env, target), libs)
+
+    def install_android_bundle(self, report: BundleReport, manifest: dict):
+        """Copy the bundle of each layer in the report and the runtime
+        manifest to the android assets dir and remove any others
+
+        """
+        assets = "android/app/src/main/assets/python"
+        bundles = [os.path.basename(path) for path in report.layers.values()]
+        names = ["python"] + [f"python-{layer}" for layer in BUNDLE_LAYERS]
+        for name in names:
+            for ext in BUNDLE_EXTENSIONS:
+                old = f"{assets}/{name}.{ext}"
+                if f"{name}.{ext}" not in bundles and exists(old):
+                    os.remove(old)
+        #: Leave the assets untouched if they are the same so gradle does not
+        #: consider them changed
+        os.makedirs(assets, exist_ok=True)
+        for src in report.layers.values():
+            dst = join(assets, os.path.basename(src))
+            shutil.copy(src, f"{dst}.tmp")
+            if not replace_if_changed(f"{dst}.tmp", dst):
+                print_color(Colors.CYAN, f"[DEBUG] {dst} is unchanged")
+        self.install_runtime_manifest(assets, manifest)
+
+    def install_runtime_manifest(self, path: str, manifest: dict):
+        """Save the runtime manifest in the path unless it is unchanged"""
+        path = join(path, RUNTIME_MANIFEST)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        replace_if_changed(f"{path}.tmp", path)
+
+    def runtime_manifest(self, mode: str, options: dict, report: BundleReport) -> dict:
+        """Describe how the app runtime should load the bundle. In extract
+        mode each layer is extracted before python starts, in tree mode the
+        files are used as is and in zipimport mode each path of a layer is
+        added to sys.path relative to the layer's bundle.
+
+        Each layer has the digest of it's bundle so the app only needs to
+        extract the layers that changed since it last ran.
+
+        The interpreter flags must match the optimization level the bundle was
+        compiled with or the pycs will not be used.
+
+        """
+        layers = []
+        paths = find_module_roots(p for p, size, compressed in report.files)
+        for name, path in report.layers.items():
+            if name in BUNDLE_LAYERS:
+                roots = [p for p in paths if bundle_layer(f"{p}/") == name]
+            else:
+                roots = paths
+            layers.append(
+                dict(
+                    name=name,
+                    bundle=os.path.basename(path),
+                    digest=file_digest(path) if os.path.isfile(path) else "",
+                    path=sorted(roots, key=len),
+                )
+            )
+        optimize = options["optimize"] if options["compile"] else 0
+        return dict(
+            version=2,
+            mode=mode,
+            format=options["fmt"],
+            layers=layers,
+            optimize=optimize,
+            invalidation=options["invalidation"],
+            flags=[f"-{'O' * optimize}"] if optimize else [],
+        )
+
+    def runtime_key(
+        self, cfg: dict, excluded: list, sources: dict, options: dict, zipimport: bool
+    ) -> str:
+        """Hash everything the runtime layer of a split bundle depends on.
+        This is the state of the packages installed in the env (conda-meta),
+        the excluded patterns, the files in the layer and the bundle options.
+
+        """
+        m = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+        for meta in sorted(glob("{conda_prefix}/conda-meta/*.json".format(**cfg))):
+            stat = os.stat(meta)
+            name = os.path.basename(meta)
+            m.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        state = dict(
+            target=cfg["target"],
+            excluded=sorted(excluded),
+            files=sorted(p for p in sources if bundle_layer(p) == "runtime"),
+            options={
+                k: v
+                for k, v in options.items()
+                if k not in ("jobs", "pyc_cache", "threads")
+            },
+            zipimport=zipimport,
+        )
+        m.update(json.dumps(state, sort_keys=True).encode())
+        return m.hexdigest()
+
+    def install_native_libs(
+        self, env: dict, target: str, excluded: list, strip: bool = False
+    ) -> list:
+        """Copy the extension modules in the target's python dir to the
+        native libs dir of it's ABI. They can't be imported from a zip so
+        each is named lib.<module>.so like those android-python installs.
+        If strip is set they are stripped and the unstripped libs are kept
+        where ndk-stack looks for symbols. Returns the names of the libs.
+
+        """
+        abi = ANDROID_TARGETS[target.split("/")[-1]]
+        default = "{conda_prefix}/android/enaml-native/src/main/libs"
+        dst = join(env.get("ndk_build_dir", default).format(**env), abi)
+        src_dir = "{conda_prefix}/{target}/python".format(target=target, **env)
+        is_excluded = compile_excluded(tuple(excluded)).match
+        paths = {}
+        for lib in glob(join(src_dir, "**", "*.so"), recursive=True):
+            path = "python/" + os.path.relpath(lib, src_dir).replace(os.sep, "/")
+            if not is_excluded(path):
+                paths[path] = lib
+        roots = find_module_roots(paths)
+
+        os.makedirs(dst, exist_ok=True)
+        app_src = "{conda_prefix}/android/enaml-native/src/main".format(**env)
+        symbols = ndk_symbols_dir(app_src, abi, ndk_built_per_abi(env))
+        libs = []
+        stripped = []
+        for path, lib in sorted(paths.items()):
+            name = module_name(path, roots)
+            if not name:
+                print_color(Colors.RED, f"[WARNING] Skipping unimportable {path}")
+                continue
+            libs.append(f"lib.{name}.so")
+            lib_dst = join(dst, libs[-1])
+            if strip:
+                os.makedirs(symbols, exist_ok=True)
+                copy_file(lib, join(symbols, libs[-1]), "copy")
+                stripped.append((lib, lib_dst))
+            elif not exists(lib_dst) or file_digest(lib) != file_digest(lib_dst):
+                shutil.copy(lib, lib_dst)
+        if stripped:
+            strip_libs(find_strip_tool(env, target), stripped)
+        print_color(Colors.CYAN, f"[DEBUG] Installed {len(libs)} native libs to {dst}")
+        return libs
+
+    def bundle_all(
+        self,
+        args,
+        root: str,
+        bundle: str,
+        options: dict,
+        zipimport: bool = False,
+        split: bool = False,
+    ) -> dict:
+        """Bundle every configured android ABI and iOS target concurrently
+        using a pool of processes. Each bundle is written to
+        `{python_build_dir}/{target}/` and the first iOS target is also
+        written to ios/assets/python.
+
+        The python files shared between targets are compiled once up front so
+        each target only needs to read them from the pyc cache. When split,
+        the files of runtime layers that are up to date are not compiled.
+
+        Targets without a `{conda_prefix}/{target}` sysroot are skipped with a
+        warning, eg iOS in an env made on linux. It only fails if none of the
+        targets are installed.
+
+        Returns a dict of the BundleReport for each target. The time spent
+        compiling the shared files is split evenly between them.
+
+        """
+        ctx = self.ctx
+        configured: list = []
+        if "android" in ctx:
+            env = ctx["android"]
+            configured.extend((f"android/{arch}", env) for arch in env["targets"])
+        if "ios" in ctx:
+            configured.extend((target, ctx["ios"]) for target in ctx["ios"]["targets"])
+        targets: list = []
+        for target, env in configured:
+            sysroot = join(env["conda_prefix"], target)
+            if os.path.isdir(sysroot):
+                targets.append((target, env))
+            else:
+                print_color(
+                    Colors.RED,
+                    f"[WARNING] Skipping {target}, {sysroot} does not exist",
+                )
+        if not targets:
+            raise EnvironmentError(
+                "Nothing to bundle, none of the targets are installed in the env"
+            )
+
+        if any(target.startswith("android") for target, env in targets):
+            self.cmds["ndk-build"].run(args)
+        ios_targets = [t for t, env in targets if not t.startswith("android")]
+        if ios_targets:
+            strip = strip_enabled(args, ctx["ios"])
+            self.collect_ios_libs(ctx["ios"], ios_targets[0], root, strip)
+
+        print_color(Colors.CYAN, "[DEBUG] Collecting sources...")
+        sources = {}
+        reports = {}
+        keys = {}
+        for target, env in targets:
+            cfg = dict(env, target=target)
+            excluded = env.get("excluded", []) + ["*.dist-info", "*.egg-info"]
+            reports[target] = report = BundleReport(target=target)
+            with report.timed("exclude"):
+                sources[target] = self.shake(
+                    self.collect_sources(cfg, root, excluded, report),
+                    cfg,
+                    env["bundle"],
+                    args.shake,
+                    report,
+                )
+            if zipimport and target.startswith("android"):
+                sources[target] = {
+                    p: s for p, s in sources[target].items() if not p.endswith(".so")
+                }
+                with report.timed("assets"):
+                    self.install_native_libs(
+                        env, target, excluded, strip_enabled(args, env)
+                    )
+            if split and target.startswith("android"):
+                keys[target] = self.runtime_key(
+                    cfg, excluded, sources[target], options, zipimport
+                )
+
+        jobs = options["jobs"] or os.cpu_count() or 1
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            pyc_cache = options["pyc_cache"]
+            if options["compile"]:
+                if not pyc_cache:
+                    #: A cache is needed to share the compiled files
+                    pyc_cache = stack.enter_context(tempfile.TemporaryDirectory())
+
+                #: Compile each unique py file once
+                exts = (".py", ".enaml") if options["enaml"] else (".py",)
+                unique: dict = {}
+                for target, env in targets:
+                    up_to_date = False
+                    if target in keys:
+                        ext = BUNDLE_FORMATS[options["fmt"]]
+                        runtime = join(
+                            env["python_build_dir"], target, f"python-runtime.{ext}"
+                        )
+                        info = read_layer_info(runtime)
+                        up_to_date = info.get("key") == keys[target]
+                    for path, src in sources[target].items():
+                        if up_to_date and bundle_layer(path) == "runtime":
+                            continue
+                        if path.endswith(exts):
+                            unique.setdefault((path, file_digest(src)), src)
+                print_color(
+                    Colors.CYAN,
+                    f"[DEBUG] Compiling {len(unique)} files shared by "
+                    f"{len(targets)} targets...",
+                )
+                compile_sources(
+                    list(unique.values()),
+                    jobs=jobs,
+                    cache_dir=pyc_cache,
+                    dfiles=[path for (path, digest) in unique],
+                    optimize=options["optimize"],
+                    invalidation=options["invalidation"],
+                )
+
+            elapsed = (time.perf_counter() - start) / len(targets)
+            for report in reports.values():
+                report.stages["compile"] = elapsed
+
+            print_color(Colors.CYAN, f"[DEBUG] Bundling {len(targets)} targets...")
+            with ProcessPoolExecutor(max_workers=min(jobs, len(targets))) as pool:
+                futures = {}
+                for target, env in targets:
+                    path = join(env["python_build_dir"], target, bundle)
+                    os.makedirs(dirname(path), exist_ok=True)
+                    tree = ""
+                    if ios_targets and target == ios_targets[0]:
+                        tree = join(root, "ios", "assets", "python")
+                    android = target.startswith("android")
+                    kwargs = dict(
+                        options,
+                        jobs=1,
+                        pyc_cache=pyc_cache,
+                        zipimport=zipimport and android,
+                        report=reports[target],
+                    )
+                    if target in keys:
+                        futures[target] = pool.submit(
+                            stream_split_bundle,
+                            sources[target],
+                            dirname(path),
+                            keys[target],
+                            **kwargs,
+                        )
+                    else:
+                        futures[target] = pool.submit(
+                            stream_bundle, sources[target], path, tree, **kwargs
+                        )
+                for target, future in futures.items():
+                    reports[target] = future.result()
+        return reports
+
+    def stage_bundle(
+        self,
+        sources: dict,
+        bundle: str,
+        config: dict,
+        incremental: bool,
+        compile: bool,
+        jobs: int,
+        pyc_cache: str,
+        fmt: str,
+        level,
+        threads: int,
+        optimize: int,
+        invalidation: str,
+        enaml: bool,
+        strip_enaml: bool,
+        report: BundleReport,
+    ):
+        """Copy the sources to the build dir, compile them and then archive
+        the build dir. The config contains the settings every staged file
+        depends on, if any of these change the whole build must be redone.
+        The stage times and file sizes are added to the report.
+
+        """
+        archive = dict(format=fmt, level=level)
+        manifest = BundleManifest(path=abspath("manifest.json"))
+        up_to_date = False
+        if incremental and manifest.load():
+            up_to_date = manifest.config == config and exists("build")
+        #: Invalidate until the build completes so an interrupted build
+        #: is never mistaken as up to date
+        manifest.invalidate()
+        if not up_to_date:
+            if incremental:
+                print_color(
+                    Colors.CYAN,
+                    "[DEBUG] Bundle manifest is missing or stale, "
+                    "doing a full rebuild...",
+                )
             #: Remove old build
             if os.path.exists("build"):
                 shutil.rmtree("build")
+            manifest.files = {}
+            manifest.archive = {}
+            manifest.sizes = []
+        manifest.config = config
+
+        #: Copy python/ and the app sources to build/ skipping anything
+        #: unchanged
+        print_color(Colors.CYAN, "[DEBUG] Copying sources...")
+        with report.timed("copy"):
+            changed, removed = self.sync_sources(sources, manifest)
+        print_color(
+            Colors.CYAN,
+            f"[DEBUG] {len(changed)} files updated, {len(removed)} removed",
+        )
 
-            #: Copy python/ build/
-            cp(
-                "{conda_prefix}/{target}/python/".format(**cfg),
-                "{python_build_dir}/build/python".format(**cfg),
-            )
+        with cd("build"), report.timed("compile"):
+            if compile:
+                # Compile to pyc
+                print_color(Colors.CYAN, "[DEBUG] Compiling py to pyc...")
+                exts = (".py", ".enaml") if enaml else (".py",)
+                py_files = [f for f in changed if f.endswith(exts)]
+                compiled, cached, failed, _ = compile_sources(
+                    py_files,
+                    jobs=jobs,
+                    cache_dir=pyc_cache,
+                    optimize=optimize,
+                    invalidation=invalidation,
+                )
+                print_color(
+                    Colors.CYAN,
+                    f"[DEBUG] {compiled} compiled, {cached} from cache, "
+                    f"{len(failed)} failed",
+                )
 
-            #: Copy sources from app source
-            for src in ctx.get("sources", ["src"]):
-                cp(join(root, src), "build")
-
-            #: Clean any excluded sources
-            with cd("build"):
-
-                if not args.no_compile:
-                    # Compile to pyc
-                    print_color(Colors.CYAN, "[DEBUG] Compiling py to pyc...")
-                    compileall.compile_dir(".", quiet=True)
-
-                    # Remove all py files
-                    print_color(Colors.CYAN, "[DEBUG] Removing py files...")
-                    for dp, dn, fn in os.walk("."):
-                        for f in glob(join(dp, "*.py")):
-                            if exists(f + "c") or exists(f + "o"):
-                                os.remove(f)
-
-                # Exclude all py files and any user added patterns
-                print_color(Colors.CYAN, "[DEBUG] Removing excluded files...")
-                for pattern in env.get("excluded", []) + ["*.dist-info", "*.egg-info"]:
-                    matches = glob(pattern)
-                    for m in matches:
-                        if os.path.isdir(m):
-                            shutil.rmtree(m)
-                        else:
-                            os.remove(m)
-
-            #: Remove old
-            for ext in [".zip", ".tar.lz4", ".so", ".tar.gz"]:
-                if exists(f"python.{ext}"):
-                    os.remove(f"python.{ext}")
+                # Remove all py files
+                print_color(Colors.CYAN, "[DEBUG] Removing py files...")
+                for f in py_files:
+                    if exists(f + "c") or exists(f + "o"):
+                        os.remove(f)
+                    elif strip_enaml and f.endswith(".enaml"):
+                        if exists(bytecode_path(f)):
+                            os.remove(f)
 
+        if changed or removed or manifest.archive != archive or not exists(bundle):
             #: Zip everything and copy to assets arch to build
-            with cd("build"):
-                print_color(Colors.CYAN, "[DEBUG] Creating python bundle...")
-                with tarfile.open("../" + bundle, "w:gz") as tar:
-                    tar.add(".")
-
-                # shprint(sh.zip, '-r',
-                # 'android/app/src/main/assets/python/python.zip', '.')
-                # shprint(sh.zip, '-r', '../python.zip', '.')
-                # shprint(sh.tar, '-zcvf', '../python.tar.gz', '.')
-                # shprint(sh.bash, '-c',
-                # 'tar czf - build | lz4 -9 - python.tar.lz4')
-                # import msgpack
-                # import lz4
-                # import lz4.frame
-                # with open('../libpybundle.so', 'wb') as source:
-                #     data = {}
-                #     for root, dirs, files in os.walk("."):
-                #         for file in files:
-                #             path = join(root, file)[2:]  # Skip ./
-                #
-                #             # TODO Compile to pyc here
-                #             with open(path, 'rb') as f:
-                #                 data[path] = f.read()
-                #     for k in data.keys():
-                #         print(k)
-                #     msgpack.pack(data, source)
-                # # Compress with lz4
-                # MINHC = lz4.frame.COMPRESSIONLEVEL_MINHC
-                # with lz4.frame.open('../libpybundle.lz4', 'wb',
-                #                     compression_level=MINHC) as f:
-                #     f.write(msgpack.packb(data))
-
-        # Copy to each lib dir
-        # for arch in env['targets']:
-        #   env['abi'] = ANDROID_TARGETS[arch]
-        #   src = '{python_build_dir}/libpybundle.so'.format(**env)
-        #   dst = '{conda_prefix}/android/enaml-native/src/main/libs/{abi}/'.format(**env)
-        #   print("Copying bundle to {}...".format(dst))
-        #   shutil.copy(src, dst)
-
-        # Copy to Android assets
-        python_build_dir = env["python_build_dir"]
-        if args.target == "android":
-            dst = f"android/app/src/main/assets/python/{bundle}"
-            cp(f"{python_build_dir}/{bundle}", dst)
+            with report.timed("archive"):
+                manifest.sizes = write_archive(
+                    bundle, iter_tree("build"), fmt, level, threads
+                )
+            manifest.archive = archive
+        report.bundle = abspath(bundle)
+        report.layers = {"python": report.bundle}
+        report.files = manifest.sizes
+
+        manifest.save()
+
+    def shake(
+        self,
+        sources: dict,
+        cfg: dict,
+        options: dict,
+        enabled: bool,
+        report: BundleReport,
+    ) -> dict:
+        """Tree shake the sources if enabled or set in the bundle options. The
+        entry modules default to the app's main and modules referenced by any
+        entry point installed in the target's site-packages are always kept.
 
-        # Copy to iOS assets
-        else:
-            # TODO Use the bundle!
-            cp(f"{python_build_dir}/build", "ios/assets/python")
+        """
+        if not (enabled or options.get("shake")):
+            return sources
+        entry, keep = self.find_entry_modules(sources, cfg, options)
+        print_color(Colors.CYAN, "[DEBUG] Tree shaking unused modules...")
+        kept, removed = shake_sources(sources, entry, keep)
+        size = sum(os.path.getsize(sources[path]) for path in removed)
+        report.shaken = size
+        print_color(
+            Colors.CYAN,
+            f"[DEBUG] Removed {len(removed)} unused files ({size} bytes)",
+        )
+        return kept
 
-            # cp('{python_build_dir}/{bundle}'.format(bundle=bundle, **env),
-            #   'ios/app/src/main/assets/python/{bundle}'.format(bundle=bundle))
+    def find_entry_modules(self, sources: dict, cfg: dict, options: dict) -> tuple:
+        """Return a tuple of the entry modules and the glob patterns of the
+        modules that must always be kept. The entry modules default to the
+        app's main and modules referenced by any entry point installed in the
+        target's site-packages are always kept.
 
-        print_color(Colors.GREEN, "[INFO] Python bundled successfully!")
+        """
+        entry = options.get("entry") or ["main"]
+        if isinstance(entry, str):
+            entry = [entry]
+        keep = SHAKE_KEEP + list(options.get("keep", []))
+
+        #: Find entry points declared by installed packages
+        sysroot = "{conda_prefix}/{target}/python".format(**cfg)
+        for path in find_module_roots(sources):
+            if path.startswith("python/") and path.endswith("site-packages"):
+                site_packages = join(sysroot, path.partition("/")[2])
+                keep.extend(read_entry_point_modules(site_packages))
+        return entry, keep
+
+    def find_unused_libs(self, env: dict, arch: str, libs: dict, root: str) -> list:
+        """Find the native libs of the android ABI that can't be reached.
+
+        The python extension modules (named lib.<module>.so) that are
+        imported by the app are found using the import graph. The libs built
+        by ndk-build and those matching a pattern in the native_keep bundle
+        option are always used. Everything these depend on (their DT_NEEDED
+        entries) is then followed. The libs map the name of each lib to it's
+        path. Returns the names of the libs that are not reached.
+
+        """
+        options = env["bundle"]
+        cfg = dict(env, target=f"android/{ANDROID_ABIS[arch]}")
+        excluded = env.get("excluded", []) + ["*.dist-info", "*.egg-info"]
+        sources = self.collect_sources(cfg, root, excluded, BundleReport())
+        entry, keep = self.find_entry_modules(sources, cfg, options)
+        modules, reachable, imports = find_reachable_modules(sources, entry, keep)
+        if not reachable & set(entry):
+            print_color(
+                Colors.RED,
+                f"[WARNING] No entry module {entry} found, can't find unused libs",
+            )
+            return []
+
+        #: Libs that did not come from the python install
+        lib_dir = "{conda_prefix}/android/{local_arch}/lib".format(
+            local_arch=ANDROID_ABIS[arch], **env
+        )
+        python_libs = {os.path.basename(lib) for lib in glob(f"{lib_dir}/*.so")}
+        native_keep = compile_excluded(tuple(options.get("native_keep", [])))
+        roots = [f"lib.{name}.so" for name in reachable | imports]
+        for name in libs:
+            if native_keep.match(name):
+                roots.append(name)
+            elif not name.startswith("lib.") and name not in python_libs:
+                roots.append(name)
+        used = find_reachable_libs(libs, roots)
+        return sorted(name for name in libs if name not in used)
+
+    def collect_sources(
+        self, cfg: dict, root: str, excluded: list, report: BundleReport
+    ) -> dict:
+        """Map each path in the bundle to the file it is copied from. Excluded
+        files and directories are skipped here so they are never copied. The
+        size of everything excluded is added to the report.
+
+        """
+        sources = {}
+        is_excluded = compile_excluded(tuple(excluded)).match
+        dirs = [("{conda_prefix}/{target}/python".format(**cfg), "python")]
+        dirs.extend((join(root, src), "") for src in self.ctx.get("sources", ["src"]))
+        for src_dir, prefix in dirs:
+            if os.path.isfile(src_dir):
+                sources[os.path.basename(src_dir)] = src_dir
+                continue
+            for dirpath, dirnames, filenames in os.walk(src_dir, followlinks=True):
+                rel_dir = os.path.relpath(dirpath, src_dir).replace(os.sep, "/")
+                rel_dir = prefix if rel_dir == "." else f"{prefix}/{rel_dir}"
+                rel_dir = rel_dir.lstrip("/")
+                kept = []
+                for d in dirnames:
+                    if is_excluded(f"{rel_dir}/{d}".lstrip("/")):
+                        report.excluded += tree_size(join(dirpath, d))
+                    else:
+                        kept.append(d)
+                dirnames[:] = kept
+                for f in filenames:
+                    path = f"{rel_dir}/{f}".lstrip("/")
+                    if is_excluded(path):
+                        report.excluded += os.path.getsize(join(dirpath, f))
+                    else:
+                        sources[path] = join(dirpath, f)
+        return sources
+
+    def sync_sources(self, sources: dict, manifest: "BundleManifest"):
+        """Copy new or modified sources into the build dir and remove any
+        that no longer exist. Returns a tuple of the changed and removed paths.
+
+        """
+        files = manifest.files
+        changed = []
+        for path, src in sources.items():
+            dst = join("build", path)
+            stat = os.stat(src)
+            entry = files.get(path)
+            if entry and exists(dst) and entry[:2] == [stat.st_size, stat.st_mtime]:
+                continue
+            digest = file_digest(src)
+            if not (entry and exists(dst) and entry[2] == digest):
+                os.makedirs(dirname(dst), exist_ok=True)
+                #: Never hardlink as the mtime is changed below
+                copy_file(src, dst, "reflink")
+                #: Compiled files record this mtime so it must match what the
+                #: bundle will use
+                os.utime(dst, (BUNDLE_MTIME, BUNDLE_MTIME))
+                changed.append(path)
+            files[path] = [stat.st_size, stat.st_mtime, digest]
+
+        removed = [path for path in files if path not in sources]
+        for path in removed:
+            del files[path]
+            dst = join("build", path)
+            stale = [dst]
+            name = os.path.splitext(os.path.basename(dst))[0]
+            if dst.endswith(".py"):
+                stale.extend([dst + "c", dst + "o"])
+                stale.extend(glob(join(dirname(dst), "__pycache__", f"{name}.*.pyc")))
+            elif dst.endswith(".enaml"):
+                cache_dir = join(dirname(dst), "__enamlcache__")
+                stale.extend(glob(join(cache_dir, f"{name}.*.enamlc")))
+            for f in stale:
+                if exists(f):
+                    os.remove(f)
+        return changed, removed
 
 
 class ListPackages(Command):
@@ -775,7 +3513,32 @@ class ListPackages(Command):
     app_dir_required = False
 
     def run(self, args):
-        shprint(self.cli.conda, "list")
+        prefix = os.environ.get("CONDA_PREFIX", "")
+        try:
+            packages = conda_packages(prefix)
+        except OSError:
+            #: Not in a conda env so let conda figure it out
+            return shprint(self.cli.conda, "list")
+        packages = dict(pip_packages(prefix), **packages)
+        print(f"# packages in environment at {prefix}:")
+        print("#")
+        print(f"# {'Name':<24}{'Version':<16}{'Build':<24}Channel")
+        for name in sorted(packages):
+            package = packages[name]
+            channel = package.get("channel")
+            if channel is None:
+                with open(package["path"]) as f:
+                    info = json.load(f)
+                channel = info.get("channel", "")
+                subdir = info.get("subdir", "")
+                if subdir and channel.endswith(f"/{subdir}"):
+                    channel = channel[: -len(subdir) - 1]
+                channel = re.sub(
+                    r"^https?://(conda\.anaconda\.org|repo\.anaconda\.com)/",
+                    "",
+                    channel,
+                )
+            print(f"{name:<26}{package['version']:<16}{package['build']:<24}{channel}")
 
 
 class Install(Command):
@@ -1756,22 +4519,120 @@ class Logcat(Command):
             except KeyboardInterrupt:
                 break
             try:
-                # Set bufsize
-                shprint(sh.adb, "logcat", _out_bufsize=64)
+                shprint(sh.adb, "logcat")
             except KeyboardInterrupt:
                 break
         print("\nDone")
 
 
+class PluginCommand(Command):
+    """Placeholder for a command installed by an entry point that is not
+    loaded. The title and help are read from the COMMANDS_CACHE so the
+    command can be listed without importing it's module.
+
+    """
+
+    def run(self, args):
+        raise RuntimeError(f"The '{self.title}' command was not loaded")
+
+
+#: Title and help of each command installed by an entry point
+COMMANDS_CACHE = join(dirname(PYC_CACHE_DIR), "commands.json")
+
+#: Path of the conda executable and the active env name by the active env
+CONDA_CACHE = join(dirname(PYC_CACHE_DIR), "conda.json")
+
+#: Normalized app contexts by the hash of the package file
+CTX_CACHE_DIR = join(dirname(PYC_CACHE_DIR), "ctx")
+
+#: Most contexts kept in the CTX_CACHE_DIR, the least recently saved are
+#: removed first
+CTX_CACHE_LIMIT = 64
+
+
+def normalize_ctx(ctx: dict) -> dict:
+    """Update the env of each platform with the defaults and the shared
+    options
+
+    """
+    excluded = list(ctx.get("excluded", []))
+
+    for env in [ctx["ios"], ctx["android"]]:
+        if "python_build_dir" not in env:
+            env["python_build_dir"] = expanduser(abspath("build/python"))
+        if "conda_prefix" not in env:
+            env["conda_prefix"] = os.environ.get(
+                "CONDA_PREFIX", expanduser(abspath("venv"))
+            )
+
+        # Join the shared and local exclusions
+        env["excluded"] = list(env.get("excluded", [])) + excluded
+
+        # Local bundle options override the shared ones
+        env["bundle"] = dict(ctx.get("bundle", {}), **env.get("bundle", {}))
+    return ctx
+
+
+def load_ctx(path: str) -> dict:
+    """Load the normalized context of the app from the package file. Returns
+    an empty dict if it is not an enaml-native env.
+
+    The file is parsed with the safe loader and the result is cached by the
+    hash of the file and everything the defaults depend on (the cwd, the
+    active env and the cli itself) so it is only parsed again if changed.
+    Contexts with values json can't save (eg dates) are not cached.
+
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    m = hashlib.sha256(data)
+    state = [os.getcwd(), os.environ.get("CONDA_PREFIX", ""), expanduser("~")]
+    state.append(str(os.stat(__file__).st_mtime_ns))
+    m.update("\n".join(state).encode())
+    cache = join(CTX_CACHE_DIR, f"{m.hexdigest()}.json")
+    try:
+        with open(cache) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    ctx = yaml.YAML(typ="safe").load(data)
+    if not isinstance(ctx, dict) or not ("ios" in ctx or "android" in ctx):
+        ctx = {}
+    else:
+        ctx = normalize_ctx(ctx)
+    try:
+        saved = json.dumps(ctx).encode()
+    except (TypeError, ValueError):
+        return ctx
+    try:
+        save_cached(cache, saved)
+        entries = glob(join(CTX_CACHE_DIR, "*.json"))
+        if len(entries) > CTX_CACHE_LIMIT:
+            entries.sort(key=os.path.getmtime)
+            for entry in entries[:-CTX_CACHE_LIMIT]:
+                os.remove(entry)
+    except OSError:
+        pass  # Read only home dir, removed by another process, etc..
+    return ctx
+
+
 def find_commands(cls):
     """Finds commands by finding the subclasses of Command"""
     cmds = []
     for subclass in cls.__subclasses__():
+        if issubclass(subclass, PluginCommand):
+            continue
         cmds.append(subclass)
         cmds.extend(find_commands(subclass))
     return cmds
 
 
+def selected_command(argv: list) -> str:
+    """Return the title of the command selected in the argv"""
+    return next((arg for arg in argv if not arg.startswith("-")), "")
+
+
 class EnamlNativeCli(Atom):
     #: Root parser
     parser = Instance(ArgumentParser)
@@ -1791,8 +4652,8 @@ class EnamlNativeCli(Atom):
     #: If enaml-native is being run within a conda (not base) env
     in_app_env = Bool()
 
-    #: Conda command
-    conda = Instance(sh.Command)
+    #: Conda command (a sh.Command)
+    conda = Value()
     conda_env_info = Dict()
 
     #: Commands
@@ -1808,16 +4669,45 @@ class EnamlNativeCli(Atom):
         """
         commands = [c() for c in find_commands(Command)]
 
-        #: Get commands installed via entry points
+        #: Get commands installed via entry points. Only the selected command
+        #: is loaded, the others are listed using the cached title and help.
+        selected = selected_command(sys.argv[1:])
+        try:
+            with open(COMMANDS_CACHE) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        changed = False
         for ep in iter_entry_points(group="enaml_native_command"):
+            dist = getattr(ep, "dist", None)
+            key = f"{ep.name} = {ep.value} ({getattr(dist, 'version', '')})"
+            info = cache.get(key)
+            if info and info["title"] != selected:
+                cls = type(
+                    f"Plugin{len(commands)}",
+                    (PluginCommand,),
+                    {"title": info["title"], "help": info["help"]},
+                )
+                commands.append(cls())
+                continue
             c = ep.load()
             if not issubclass(c, Command):
                 print(
                     f"Warning: entry point {ep.name} did not return a valid enaml "
                     "cli command! This command will be ignored!"
                 )
+                continue
             commands.append(c())
+            cache[key] = dict(title=c.title, help=c.help)
+            changed = True
 
+        if changed:
+            try:
+                os.makedirs(dirname(COMMANDS_CACHE), exist_ok=True)
+                with open(COMMANDS_CACHE, "w") as f:
+                    json.dump(cache, f, indent=2)
+            except OSError:
+                pass  # Read only home dir, etc..
         return commands
 
     def _default_in_app_directory(self):
@@ -1826,52 +4716,41 @@ class EnamlNativeCli(Atom):
         app.
 
         """
+        return bool(self.ctx)
+
+    def _default_ctx(self):
+        """Return the package config or context with some of the values
+        normalized. The package file is only parsed once.
+
+        """
+        ctx = {}
         if exists(self.package):
             # Look for enaml-native specific sections
             try:
-                with open(self.package) as f:
-                    ctx = dict(yaml.load(f, Loader=yaml.RoundTripLoader))
-                    return "ios" in ctx or "android" in ctx
+                ctx = load_ctx(self.package)
             except Exception as e:
                 print_color(Colors.RED, f"Could not load environment.yml: {e}")
-        return False
-
-    def _default_ctx(self):
-        """Return the package config or context and normalize some of the
-        values
-
-        """
-        if not self.in_app_directory:
+        if not ctx:
             print(
                 f"Warning: {self.package} is missing or not an "
                 "enaml-native env. Using the default."
             )
-            ctx = {}
-
-        else:
-            with open(self.package) as f:
-                ctx = dict(yaml.load(f, Loader=yaml.RoundTripLoader))
-
-        if self.in_app_directory:
-            # Update the env for each platform
-            excluded = list(ctx.get("excluded", []))
-
-            for env in [ctx["ios"], ctx["android"]]:
-                if "python_build_dir" not in env:
-                    env["python_build_dir"] = expanduser(abspath("build/python"))
-                if "conda_prefix" not in env:
-                    env["conda_prefix"] = os.environ.get(
-                        "CONDA_PREFIX", expanduser(abspath("venv"))
-                    )
-
-                # Join the shared and local exclusions
-                env["excluded"] = list(env.get("excluded", [])) + excluded
-
         return ctx
 
     def _default_parser(self):
         """Generate a parser using the command list"""
         parser = ArgumentParser(prog="enaml-native")
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            help="Refresh the cached conda info before running the command",
+        )
+        parser.add_argument(
+            "--daemon",
+            action="store_true",
+            help="Run the command in the background daemon of the app. "
+            "This can also be enabled by setting ENAML_NATIVE_DAEMON=1",
+        )
 
         #: Build commands by name
         cmds = {c.title: c for c in self.commands}
@@ -1891,11 +4770,12 @@ class EnamlNativeCli(Atom):
         return parser
 
     def _default_conda(self):
-        return find_conda()
+        path = self.conda_env_info.get("conda")
+        return sh.Command(path) if path else find_conda()
 
-    def check_dependencies(self):
+    def check_dependencies(self, refresh: bool = False):
         try:
-            info = json.loads(str(self.conda("info", "--json")))
+            info = conda_info(refresh)
             base_envs = ("base", "test")
             self.in_app_env = info["active_prefix_name"] not in base_envs
             self.conda_env_info = info
@@ -1924,7 +4804,6 @@ class EnamlNativeCli(Atom):
 
     def start(self):
         """Run the commands"""
-        self.check_dependencies()
         self.args = self.parser.parse_args()
 
         # Python 3 doesn't set the cmd if no args are given
@@ -1933,6 +4812,9 @@ class EnamlNativeCli(Atom):
             return
 
         cmd = self.args.cmd
+        #: Only commands that must run in an app env need conda
+        if cmd.app_env_required:
+            self.check_dependencies(self.args.refresh)
         self.check_setup(cmd)
         try:
             cmd.run(self.args)
@@ -1940,7 +4822,396 @@ class EnamlNativeCli(Atom):
             raise
 
 
+#: Sockets, locks and logs of the daemon of each app
+DAEMON_DIR = join(dirname(PYC_CACHE_DIR), "daemon")
+
+#: Seconds the daemon waits for a command before it exits
+DAEMON_IDLE_TIMEOUT = 3 * 3600
+
+#: Commands that are always run directly, they either prompt for input, never
+#: exit or manage the daemon itself
+DAEMON_EXCLUDED = ("", "create", "daemon", "start")
+
+
+def daemon_socket_path() -> str:
+    """Return the path of the socket of the daemon for the app in the cwd"""
+    name = hashlib.sha256(os.getcwd().encode()).hexdigest()[:16]
+    return join(DAEMON_DIR, f"{name}.sock")
+
+
+def daemon_key(package: str = "environment.yml") -> str:
+    """Return a key of everything a warm daemon depends on. If the key of a
+    request does not match the daemon's it is restarted.
+
+    """
+    state = [sys.executable, os.environ.get("CONDA_PREFIX", "")]
+    for path in (package, __file__):
+        try:
+            st = os.stat(path)
+            state.append(f"{st.st_mtime_ns}:{st.st_size}")
+        except OSError:
+            state.append("")
+    return ":".join(state)
+
+
+def send_frame(conn, kind: bytes, data: bytes = b""):
+    """Send a frame of output (o), the exit code (x) or a restart (r)"""
+    conn.sendall(struct.pack("!cI", kind, len(data)) + data)
+
+
+def recv_frame(conn) -> tuple:
+    """Receive a frame sent with send_frame and return the kind and data"""
+    kind, size = struct.unpack("!cI", recv_exact(conn, 5))
+    return kind, recv_exact(conn, size)
+
+
+def recv_exact(conn, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The daemon closed the connection")
+        data += chunk
+    return data
+
+
+def spawn_daemon(idle_timeout: int = DAEMON_IDLE_TIMEOUT):
+    """Start the daemon for the app in the cwd in a new session"""
+    import subprocess
+
+    os.makedirs(DAEMON_DIR, exist_ok=True)
+    log = daemon_socket_path().replace(".sock", ".log")
+    with open(log, "ab") as f:
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "enamlnativecli.main",
+                "daemon",
+                "run",
+                "--idle-timeout",
+                str(idle_timeout),
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=f,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+
+def connect_daemon(spawn: bool = False, timeout: float = 0):
+    """Connect to the daemon of the app in the cwd, retrying until the
+    timeout. If spawn is set and it is not running it is started. Returns None
+    if it can't be reached.
+
+    """
+    import socket
+
+    path = daemon_socket_path()
+    deadline = time.time() + timeout
+    spawned = False
+    while True:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(path)
+            return conn
+        except OSError:
+            conn.close()
+        if time.time() > deadline:
+            return None
+        if spawn and not spawned:
+            spawn_daemon()
+            spawned = True
+        time.sleep(0.05)
+
+
+def run_in_daemon(argv: list, action: str = "run"):
+    """Send the command to the daemon of the app in the cwd, starting it if
+    needed, and stream it's output. Returns the exit code of the command or
+    None if the daemon could not be used.
+
+    """
+    import socket
+
+    if IS_WIN or not hasattr(socket, "AF_UNIX"):
+        return None
+    request = dict(
+        action=action,
+        argv=argv,
+        cwd=os.getcwd(),
+        env=dict(os.environ),
+        key=daemon_key(),
+    )
+    data = json.dumps(request).encode() + b"\n"
+    out = sys.stdout.buffer
+    spawn = action == "run"
+
+    #: Retry once if the daemon is restarted
+    for attempt in range(2):
+        conn = connect_daemon(spawn, timeout=10 if spawn else 0)
+        if conn is None:
+            return None
+        received = False
+        with conn:
+            try:
+                conn.sendall(data)
+                while True:
+                    kind, chunk = recv_frame(conn)
+                    received = True
+                    if kind == b"o":
+                        out.write(chunk)
+                        out.flush()
+                    elif kind == b"x":
+                        return int(chunk)
+                    else:
+                        break  # Restarting
+            except OSError as e:
+                if received:
+                    print_color(Colors.RED, f"[WARNING] Daemon failed: {e}")
+                    return 1
+                # Closed before the command started, eg it was stopping
+    return None
+
+
+class Daemon(Command):
+    """Keep a warm process with the cli, app context and conda info loaded
+    which runs the commands sent by `enaml-native --daemon <cmd>` (or with
+    ENAML_NATIVE_DAEMON=1 set, eg for gradle builds) in a fork of itself.
+
+    The daemon listens on a unix socket for the app, exits when idle for the
+    timeout and is restarted when the environment.yml, the active env or the
+    cli changes.
+
+    """
+
+    title = "daemon"
+    help = "Start, stop or check the background daemon of the app"
+    args = [
+        (
+            "action",
+            dict(
+                help="What to do with the daemon",
+                choices=["start", "stop", "status", "run"],
+                nargs="?",
+                default="status",
+            ),
+        ),
+        (
+            "--idle-timeout",
+            dict(
+                type=int,
+                default=DAEMON_IDLE_TIMEOUT,
+                help="Seconds without a command before the daemon exits",
+            ),
+        ),
+    ]
+
+    #: The daemon runs the commands in the env that was active when started
+    app_env_required = False
+
+    #: Pids of the forks running commands
+    workers = Dict()
+
+    def run(self, args):
+        if IS_WIN:
+            raise EnvironmentError("The daemon is not supported on windows")
+        if args.action == "run":
+            return self.serve(args.idle_timeout)
+        if args.action == "start":
+            if connect_daemon() is None:
+                spawn_daemon(args.idle_timeout)
+            if connect_daemon(timeout=10) is None:
+                raise RuntimeError(
+                    "The daemon did not start. See the log in "
+                    f"{daemon_socket_path().replace('.sock', '.log')}"
+                )
+        action = "status" if args.action == "start" else args.action
+        if run_in_daemon([], action) is None:
+            print("The daemon is not running")
+
+    def serve(self, idle_timeout: int):
+        """Accept commands until the daemon is idle, stopped or stale"""
+        import fcntl
+        import select
+        import socket
+
+        path = daemon_socket_path()
+        os.makedirs(DAEMON_DIR, exist_ok=True)
+        lock = open(path.replace(".sock", ".lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            print("The daemon is already running")
+            return
+
+        # Load everything commands use now
+        key = daemon_key()
+        cli: Any = self.cli
+        try:
+            cli.check_dependencies()
+        except EnvironmentError:
+            pass
+        preload(sh, yaml)
+
+        if exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+        print_color(Colors.GREEN, f"[INFO] Daemon {os.getpid()} listening on {path}")
+
+        def shutdown(reason: str):
+            """Stop accepting so a new daemon can start right away"""
+            print(f"[INFO] Daemon stopping: {reason}")
+            server.close()
+            os.unlink(path)
+            lock.close()
+
+        def reap():
+            """Remove the workers that finished and return if any did"""
+            done = [pid for pid in self.workers if os.waitpid(pid, os.WNOHANG)[0]]
+            for pid in done:
+                del self.workers[pid]
+            return bool(done)
+
+        last = time.time()
+        try:
+            while server.fileno() != -1 or self.workers:
+                if reap():
+                    last = time.time()
+                if server.fileno() == -1:
+                    time.sleep(0.1)
+                    continue
+                if not self.workers:
+                    if time.time() - last > idle_timeout:
+                        shutdown("idle")
+                        continue
+                    if daemon_key() != key:
+                        shutdown("the env or cli changed")
+                        continue
+                if not select.select([server], [], [], 1)[0]:
+                    continue
+                conn, _ = server.accept()
+                try:
+                    conn.settimeout(5)
+                    line = conn.makefile("rb").readline()
+                    conn.settimeout(None)
+                    if not line:
+                        continue  # Only checking if it's running
+                    request = json.loads(line)
+                    action = request["action"]
+                    if action == "stop":
+                        shutdown("stopped")
+                        send_frame(conn, b"x", b"0")
+                    elif action == "status":
+                        reap()
+                        msg = (
+                            f"Daemon {os.getpid()} is running on {path} with "
+                            f"{len(self.workers)} commands running\n"
+                        )
+                        send_frame(conn, b"o", msg.encode())
+                        send_frame(conn, b"x", b"0")
+                    elif request["key"] != key:
+                        shutdown("the env or cli changed")
+                        send_frame(conn, b"r")
+                    else:
+                        pid = os.fork()
+                        if pid == 0:
+                            server.close()
+                            lock.close()
+                            self.execute(conn, request)
+                        self.workers[pid] = request["argv"]
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"[WARNING] Invalid request: {e}")
+                finally:
+                    conn.close()
+        finally:
+            if server.fileno() != -1:
+                shutdown("exiting")
+
+    def execute(self, conn, request: dict):
+        """Run the command of the request and send the output and exit code
+        to the client. This runs in a fork of the daemon and never returns.
+
+        """
+        import signal
+        import traceback
+
+        code = 1
+        try:
+            r, w = os.pipe()
+
+            def relay():
+                interrupted = False
+                with open(r, "rb", buffering=0) as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b""):
+                        if interrupted:
+                            continue
+                        try:
+                            send_frame(conn, b"o", chunk)
+                        except OSError:
+                            # Client is gone, stop the command
+                            interrupted = True
+                            os.kill(os.getpid(), signal.SIGINT)
+
+            thread = threading.Thread(target=relay, daemon=True)
+            thread.start()
+
+            # Redirect everything, including the output of subprocesses
+            null = os.open(os.devnull, os.O_RDWR)
+            os.dup2(null, 0)
+            os.dup2(w, 1)
+            os.dup2(w, 2)
+            os.close(w)
+            sys.stdout = open(1, "w", buffering=1, closefd=False)
+            sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            sys.argv = ["enaml-native"] + request["argv"]
+
+            #: Plugins are only loaded when selected
+            cli: Any = self.cli
+            selected = selected_command(request["argv"])
+            cmds = {c.title: c for c in cli.commands}
+            if isinstance(cmds.get(selected), PluginCommand):
+                cli = EnamlNativeCli()
+            try:
+                cli.start()
+                code = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    code = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(null, 1)
+                os.dup2(null, 2)
+                thread.join()
+            send_frame(conn, b"x", str(code).encode())
+        finally:
+            os._exit(code)
+
+
+def use_daemon(argv: list) -> bool:
+    """Return if the command should be sent to the daemon"""
+    if selected_command(argv) in DAEMON_EXCLUDED or not exists("environment.yml"):
+        return False
+    return "--daemon" in argv or os.environ.get("ENAML_NATIVE_DAEMON") == "1"
+
+
 def main():
+    argv = sys.argv[1:]
+    if use_daemon(argv):
+        code = run_in_daemon(argv)
+        if code is not None:
+            sys.exit(code)
     EnamlNativeCli().start()
 
 
@@ -0,0 +1,586 @@
+"""
+Copyright (c) 2017, Jairus Martin.
+
+Distributed under the terms of the MIT License.
+
+The full license is in the file COPYING.txt, distributed with this software.
+
+Created on Oct 18, 2026
+"""
+
+import json
+import os
+import struct
+import subprocess
+import sys
+import tarfile
+import time
+import zipimport
+from argparse import ArgumentParser, Namespace
+
+import pytest
+
+from enamlnativecli import main
+from enamlnativecli.main import (
+    BUNDLE_MTIME,
+    BundleAssets,
+    BundleManifest,
+    BundleReport,
+    bundle_layer,
+    bundle_package,
+    bytecode_path,
+    cd,
+    compile_pyc,
+    compile_sources,
+    cp,
+    file_digest,
+    find_imports,
+    find_reachable_libs,
+    is_excluded,
+    iter_bundle_entries,
+    iter_tree,
+    module_name,
+    read_elf_needed,
+    shake_sources,
+    stream_bundle,
+    stream_split_bundle,
+    strip_libs,
+    write_bundle,
+    write_if_changed,
+)
+
+
+def test_is_excluded():
+    patterns = ["idlelib", "site-packages/enaml/qt", "*.dist-info", "lib._sqlite3.so"]
+    assert is_excluded("idlelib", patterns)
+    assert is_excluded("python/idlelib/__init__.py", patterns)
+    assert is_excluded("python/site-packages/enaml/qt/qt_widget.py", patterns)
+    assert is_excluded("python/site-packages/foo-1.0.dist-info/METADATA", patterns)
+    assert is_excluded("lib._sqlite3.so", patterns)
+    assert not is_excluded("python/site-packages/enaml/core/parser.py", patterns)
+    assert not is_excluded("python/site-packages/enaml/qtx.py", patterns)
+    assert not is_excluded("main.py", patterns)
+    assert not is_excluded("main.py", [])
+
+
+def test_is_excluded_globs():
+    assert is_excluded("a/b/test/c.py", ["a/**/c.py"])
+    assert is_excluded("a/c.py", ["a/**/c.py"])
+    assert not is_excluded("a/b/c.py", ["a/*.py"])
+    assert is_excluded("x/a/b.py", ["a/*.py"])
+    assert not is_excluded("x/a/b.py", ["/a/*.py"])
+    assert is_excluded("a/b.py", ["/a/*.py"])
+    assert is_excluded("lib._ctypes.so", ["lib._c[!o]*"])
+    assert not is_excluded("lib._codecs.so", ["lib._c[!o]*"])
+
+
+def test_bundle_manifest(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = BundleManifest(path=path)
+    assert not manifest.load()
+
+    manifest.config = {"excluded": ["idlelib"], "compile": True}
+    manifest.files = {"main.py": [10, 1.5, "abc"]}
+    manifest.save()
+
+    loaded = BundleManifest(path=path)
+    assert loaded.load()
+    assert loaded.config == manifest.config
+    assert loaded.files == manifest.files
+
+    loaded.invalidate()
+    assert not BundleManifest(path=path).load()
+
+
+def test_compile_sources_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    src = tmp_path / "src"
+    src.mkdir()
+    for i in range(4):
+        (src / f"mod{i}.py").write_text(f"x = {i}\n")
+    with cd(str(src)):
+        paths = sorted(os.listdir("."))
+        assert compile_sources(paths, jobs=2, cache_dir=cache_dir) == (4, 0, [], {})
+        assert compile_sources(paths, jobs=2, cache_dir=cache_dir) == (0, 4, [], {})
+        assert len(os.listdir("__pycache__")) == 4
+
+
+def test_compile_pyc_release(tmp_path):
+    src = tmp_path / "mod.py"
+    src.write_text('"""Docs"""\nassert False\nvalue = 1\n')
+    dfile, cached, error, data = compile_pyc(
+        str(src), optimize=2, invalidation="unchecked-hash"
+    )
+    assert not error
+    assert (
+        tmp_path / "__pycache__" / f"mod.{sys.implementation.cache_tag}.opt-2.pyc"
+    ).exists()
+
+    #: An unchecked pyc is used even when the source changes
+    src.write_text("value = 2\n")
+    code = "import mod; print(mod.__doc__, mod.value)"
+    out = subprocess.check_output(
+        [sys.executable, "-OO", "-c", code], cwd=str(tmp_path), text=True
+    )
+    assert out.strip() == "None 1"
+
+
+def test_compile_enaml(tmp_path):
+    pytest.importorskip("enaml")
+    views = tmp_path / "views"
+    views.mkdir()
+    (views / "__init__.py").write_text("")
+    (views / "app.enaml").write_text(
+        "from enaml.widgets.api import Window\n\n"
+        "enamldef Main(Window):\n"
+        "    attr greeting = 'hello'\n"
+    )
+    with cd(str(tmp_path)):
+        assert compile_sources(["views/app.enaml"], jobs=1)[:3] == (1, 0, [])
+        assert os.path.exists(bytecode_path("views/app.enaml"))
+        os.remove("views/app.enaml")
+
+    #: Enaml's importer loads the cache without the source
+    code = "import enaml\nwith enaml.imports():\n    from views.app import Main\n"
+    subprocess.check_call([sys.executable, "-c", code], cwd=str(tmp_path))
+
+
+@pytest.mark.parametrize("fmt", ["gz", "xz", "tar", "zip"])
+def test_write_bundle_reproducible(tmp_path, fmt):
+    src = tmp_path / "build"
+    (src / "pkg").mkdir(parents=True)
+    (src / "pkg" / "__init__.py").write_text("x = 1\n")
+    (src / "main.py").write_text("import pkg\n")
+
+    first = str(tmp_path / "first")
+    write_bundle(first, iter_tree(str(src)), fmt)
+    time.sleep(1)
+    os.utime(src / "main.py")
+    second = str(tmp_path / "second")
+    write_bundle(second, iter_tree(str(src)), fmt)
+    assert file_digest(first) == file_digest(second)
+
+
+@pytest.mark.parametrize("fmt", ["gz", "xz", "tar", "zip"])
+def test_write_bundle_sizes(tmp_path, fmt):
+    src = tmp_path / "build"
+    (src / "pkg").mkdir(parents=True)
+    (src / "pkg" / "__init__.py").write_text("x = 1\n" * 1000)
+    (src / "main.py").write_text("import pkg\n")
+
+    path = str(tmp_path / "bundle")
+    sizes = write_bundle(path, iter_tree(str(src)), fmt)
+    assert [[name, size] for name, size, compressed in sizes] == [
+        ["main.py", 11],
+        ["pkg/__init__.py", 6000],
+    ]
+    if fmt != "zip":
+        #: Compressed sizes account for the whole archive
+        assert sum(compressed for name, size, compressed in sizes) <= os.path.getsize(
+            path
+        )
+
+
+def test_bundle_report(tmp_path):
+    assert bundle_package("main.py", [""]) == "main"
+    assert bundle_package("__pycache__/main.cpython-39.pyc", [""]) == "main"
+    roots = ["python/site-packages", "python", ""]
+    assert bundle_package("python/site-packages/enaml/core/a.py", roots) == "enaml"
+    assert bundle_package("python/site-packages/six.py", roots) == "six"
+    assert bundle_package("python/_ssl.cpython-39.so", roots) == "_ssl"
+
+    report = BundleReport(
+        target="android/arm64",
+        files=[
+            ["main.py", 10, 5],
+            ["python/site-packages/enaml/__init__.py", 100, 50],
+            ["python/site-packages/enaml/core/__init__.py", 100, 50],
+        ],
+    )
+    with report.timed("compile"):
+        pass
+    assert report.packages() == {"main": [1, 10, 5], "enaml": [2, 200, 100]}
+    assert "compile" in report.stages
+
+    path = str(tmp_path / "report.json")
+    assert BundleReport.load(path) is None
+    report.save(path)
+    loaded = BundleReport.load(path)
+    assert loaded.packages() == report.packages()
+    loaded.print_summary(report)
+
+
+def test_stream_entries_match_tree(tmp_path):
+    src = tmp_path / "build"
+    (src / "a" / "b").mkdir(parents=True)
+    (src / "a" / "b" / "c.py").write_text("c = 1\n")
+    (src / "a.py").write_text("a = 1\n")
+    (src / "z.txt").write_text("z")
+    files = {
+        "z.txt": str(src / "z.txt"),
+        "a/b/c.py": str(src / "a" / "b" / "c.py"),
+        "a.py": str(src / "a.py"),
+    }
+    staged = [(name, bool(source)) for name, source in iter_tree(str(src))]
+    streamed = [(name, bool(source)) for name, source in iter_bundle_entries(files)]
+    assert staged == streamed
+
+    first = str(tmp_path / "first")
+    write_bundle(first, iter_tree(str(src)), "gz")
+    second = str(tmp_path / "second")
+    write_bundle(second, iter_bundle_entries(files), "gz")
+    assert file_digest(first) == file_digest(second)
+
+
+def test_find_imports():
+    source = """
+from enaml.widgets.api import (
+    Window,
+    Container,
+)
+import os.path as osp, sys
+from . import sibling
+from ..core import parser
+
+enamldef Main(Window):
+    clicked :: import json
+"""
+    assert find_imports(source, "pkg.sub.view", False) == {
+        "enaml.widgets.api",
+        "enaml.widgets.api.Window",
+        "enaml.widgets.api.Container",
+        "os.path",
+        "sys",
+        "pkg.sub",
+        "pkg.sub.sibling",
+        "pkg.core",
+        "pkg.core.parser",
+        "json",
+    }
+
+
+def test_shake_sources(tmp_path):
+    files = {
+        "main.py": "import enaml\nfrom views import app\n",
+        "views/__init__.py": "",
+        "views/app.enaml": "from enaml.widgets.api import Window\n",
+        "python/encodings/__init__.py": "",
+        "python/json/__init__.py": "",
+        "python/site-packages/enaml/__init__.py": "",
+        "python/site-packages/enaml/widgets/__init__.py": "",
+        "python/site-packages/enaml/widgets/api.py": "from .window import Window\n",
+        "python/site-packages/enaml/widgets/window.py": "",
+        "python/site-packages/enaml/widgets/unused.py": "",
+        "python/site-packages/enaml/qt/__init__.py": "",
+        "python/site-packages/enaml/qt/icons.txt": "",
+    }
+    sources = {}
+    for path, content in files.items():
+        src = tmp_path / path
+        src.parent.mkdir(parents=True, exist_ok=True)
+        src.write_text(content)
+        sources[path] = str(src)
+
+    kept, removed = shake_sources(sources, ["main"], ["encodings"])
+    assert sorted(removed) == [
+        "python/json/__init__.py",
+        "python/site-packages/enaml/qt/__init__.py",
+        "python/site-packages/enaml/qt/icons.txt",
+        "python/site-packages/enaml/widgets/unused.py",
+    ]
+    assert "views/app.enaml" in kept
+    assert "python/site-packages/enaml/widgets/window.py" in kept
+
+
+def test_module_name():
+    roots = ["python/lib/python3.9/lib-dynload", "python/lib/python3.9", "python", ""]
+    assert module_name("python/lib/python3.9/json/__init__.py", roots) == "json"
+    so = "python/lib/python3.9/lib-dynload/_ssl.cpython-39-x86_64-linux-gnu.so"
+    assert module_name(so, roots) == "_ssl"
+    assert module_name("python/site-packages.txt", roots) == ""
+
+
+def test_stream_bundle_zipimport(tmp_path):
+    src = tmp_path / "src"
+    (src / "pkg").mkdir(parents=True)
+    (src / "pkg" / "__init__.py").write_text("value = 42\n")
+    (src / "main.py").write_text("from pkg import value\n")
+    sources = {
+        "main.py": str(src / "main.py"),
+        "python/site-packages/pkg/__init__.py": str(src / "pkg" / "__init__.py"),
+    }
+    bundle = str(tmp_path / "python.zip")
+    report = stream_bundle(sources, bundle, jobs=1, fmt="zip", zipimport=True)
+    assert [path for path, size, compressed in report.files] == [
+        "main.pyc",
+        "python/site-packages/pkg/__init__.pyc",
+    ]
+
+    importer = zipimport.zipimporter(f"{bundle}/python/site-packages")
+    namespace: dict = {}
+    exec(importer.get_code("pkg"), namespace)
+    assert namespace["value"] == 42
+
+
+def test_bundle_layer():
+    assert bundle_layer("python/site-packages/pkg/__init__.py") == "runtime"
+    assert bundle_layer("python/lib-dynload/_json.so") == "runtime"
+    assert bundle_layer("main.py") == "app"
+    assert bundle_layer("pythonic.py") == "app"
+
+
+def test_stream_split_bundle(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "lib.py").write_text("x = 1\n")
+    (src / "main.py").write_text("import lib\n")
+    sources = {
+        "main.py": str(src / "main.py"),
+        "python/site-packages/lib.py": str(src / "lib.py"),
+    }
+    out = tmp_path / "out"
+    out.mkdir()
+    report = stream_split_bundle(sources, str(out), "a", compile=False)
+    assert set(report.layers) == {"runtime", "app"}
+    assert len(report.files) == 2
+    runtime = out / "python-runtime.tar.gz"
+    with tarfile.open(runtime) as tar:
+        files = [m.name for m in tar.getmembers() if m.isfile()]
+        assert files == ["./python/site-packages/lib.py"]
+    with tarfile.open(out / "python-app.tar.gz") as tar:
+        files = [m.name for m in tar.getmembers() if m.isfile()]
+        assert files == ["./main.py"]
+
+    #: The runtime layer is only rebuilt when the key changes
+    os.utime(runtime, ns=(0, 0))
+    report = stream_split_bundle(sources, str(out), "a", compile=False)
+    assert runtime.stat().st_mtime_ns == 0
+    assert len(report.files) == 2
+    (src / "lib.py").write_text("x = 2\n")
+    stream_split_bundle(sources, str(out), "b", compile=False)
+    assert runtime.stat().st_mtime_ns != 0
+
+
+def test_bundle_all(tmp_path):
+    prefix = tmp_path / "venv"
+    (prefix / "android" / "x86_64" / "python").mkdir(parents=True)
+    (prefix / "android" / "x86_64" / "python" / "lib.py").write_text("x = 1\n")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "main.py").write_text("import lib\n")
+    env = dict(
+        conda_prefix=str(prefix),
+        python_build_dir=str(tmp_path / "build"),
+        excluded=[],
+        bundle={},
+    )
+    ctx = dict(
+        android=dict(env, targets=["x86_64"]),
+        ios=dict(env, targets=["iphoneos", "iphonesimulator"]),
+    )
+    builds = []
+
+    class NdkBuild:
+        def run(self, args):
+            builds.append(args)
+
+    cmd = BundleAssets(ctx=ctx, cmds={"ndk-build": NdkBuild()})
+    args = Namespace(shake=False)
+    options = dict(
+        compile=False,
+        jobs=1,
+        pyc_cache="",
+        fmt="gz",
+        level=None,
+        threads=0,
+        optimize=0,
+        invalidation="timestamp",
+        enaml=False,
+        strip_enaml=False,
+    )
+    root = str(tmp_path)
+
+    #: Targets without a sysroot are skipped
+    reports = cmd.bundle_all(args, root, "python.tar.gz", options)
+    assert list(reports) == ["android/x86_64"]
+    assert len(builds) == 1
+
+    #: The libs of the first iOS target are collected
+    (prefix / "iphoneos" / "python").mkdir(parents=True)
+    (prefix / "iphoneos" / "lib").mkdir()
+    (prefix / "iphoneos" / "lib" / "libfoo.dylib").write_bytes(b"lib")
+    reports = cmd.bundle_all(args, root, "python.tar.gz", options)
+    assert list(reports) == ["android/x86_64", "iphoneos"]
+    assert (tmp_path / "ios" / "Libs" / "libfoo.dylib").exists()
+    assert (tmp_path / "ios" / "assets" / "python" / "main.py").exists()
+
+    #: The runtime manifest of the iOS tree is written too
+    parser = ArgumentParser()
+    for flags, kwargs in BundleAssets.args:
+        parser.add_argument(*flags.split(), **kwargs)
+    cmd.ctx.update(bundle_id="com.example.app")
+    with cd(root):
+        cmd.run(parser.parse_args(["--all", "--release", "--no-cache"]))
+    manifest = tmp_path / "ios" / "assets" / "python" / "bundle.json"
+    assert json.loads(manifest.read_text())["mode"] == "tree"
+
+    #: Fails if nothing can be bundled
+    ctx["android"]["targets"] = ["arm64"]
+    ctx["ios"]["targets"] = ["iphonesimulator"]
+    with pytest.raises(EnvironmentError):
+        cmd.bundle_all(args, root, "python.tar.gz", options)
+
+
+def test_install_native_libs_symbols(tmp_path, monkeypatch):
+    prefix = tmp_path / "venv"
+    lib = prefix / "android" / "x86_64" / "python" / "site-packages" / "_foo.so"
+    lib.parent.mkdir(parents=True)
+    lib.write_bytes(b"\x7fELF")
+    build = tmp_path / "build"
+    build.mkdir()
+    env = dict(
+        conda_prefix=str(prefix),
+        python_build_dir=str(build),
+        bundle=dict(strip_tool="strip"),
+    )
+    stripped = []
+    monkeypatch.setattr(main, "strip_libs", lambda cmd, libs: stripped.extend(libs))
+    cmd = BundleAssets(ctx=dict(android=env))
+    obj = prefix / "android" / "enaml-native" / "src" / "main" / "obj"
+
+    #: The unstripped libs are kept where ndk-stack reads the symbols
+    for per_abi, symbols in [
+        (False, obj / "local" / "x86_64"),
+        (True, obj / "x86_64" / "local" / "x86_64"),
+    ]:
+        (build / "ndk-build.json").write_text(json.dumps(dict(per_abi=per_abi)))
+        libs = cmd.install_native_libs(env, "android/x86_64", [], strip=True)
+        assert libs == ["lib._foo.so"]
+        assert (symbols / "lib._foo.so").read_bytes() == b"\x7fELF"
+
+
+def test_cp(tmp_path):
+    src = tmp_path / "src"
+    (src / "pkg").mkdir(parents=True)
+    (src / "a.py").write_text("a = 1\n")
+    (src / "pkg" / "b.py").write_text("b = 1\n")
+    dst = tmp_path / "dst"
+    assert cp(str(src), str(dst)) == (12, 0)
+    assert (dst / "pkg" / "b.py").read_text() == "b = 1\n"
+
+    #: Unchanged files are skipped
+    assert cp(str(src), str(dst)) == (0, 12)
+    (src / "a.py").write_text("a = 22\n")
+    assert cp(str(src), str(dst)) == (7, 6)
+    assert (dst / "a.py").read_text() == "a = 22\n"
+
+    #: Same size edits are copied even if the mtime is the same, eg when
+    #: staged with the BUNDLE_MTIME
+    (src / "a.py").write_text("a = 33\n")
+    os.utime(src / "a.py", (BUNDLE_MTIME, BUNDLE_MTIME))
+    os.utime(dst / "a.py", (BUNDLE_MTIME, BUNDLE_MTIME))
+    assert cp(str(src), str(dst)) == (7, 6)
+    assert (dst / "a.py").read_text() == "a = 33\n"
+    assert cp(str(src), str(dst)) == (0, 13)
+
+    #: Other files are skipped by the size and mtime alone
+    (src / "a.py").write_text("a = 44\n")
+    os.utime(src / "a.py", (0, 0))
+    os.utime(dst / "a.py", (0, 0))
+    assert cp(str(src), str(dst)) == (0, 13)
+
+    linked = tmp_path / "linked"
+    cp(str(src), str(linked), "hardlink")
+    assert os.path.samefile(src / "a.py", linked / "a.py")
+
+
+def test_write_if_changed(tmp_path):
+    path = str(tmp_path / "Android.mk")
+    assert write_if_changed(path, "PY_LIB_VER := 3.11\n")
+    os.utime(path, ns=(0, 0))
+    assert not write_if_changed(path, "PY_LIB_VER := 3.11\n")
+    assert os.stat(path).st_mtime_ns == 0
+    assert write_if_changed(path, "PY_LIB_VER := 3.12\n")
+
+
+def test_strip_libs(tmp_path):
+    #: A fake strip tool that keeps the first 4 bytes
+    tool = tmp_path / "strip"
+    tool.write_text('#!/bin/sh\nhead -c 4 "$3" > "$2"\n')
+    tool.chmod(0o755)
+    lib = tmp_path / "libfoo.so"
+    lib.write_bytes(b"\x7fELF" + b"\0" * 60)
+    dst = tmp_path / "out"
+    dst.mkdir()
+    cache = str(tmp_path / "cache")
+    libs = [(str(lib), str(dst / "libfoo.so"))]
+    assert strip_libs([str(tool)], libs, cache) == (64, 4)
+    assert (dst / "libfoo.so").read_bytes() == b"\x7fELF"
+
+    #: Stripped libs are cached
+    tool.write_text("#!/bin/sh\nexit 1\n")
+    (dst / "libfoo.so").unlink()
+    assert strip_libs([str(tool)], libs, cache) == (64, 4)
+
+
+def write_elf(path, needed):
+    """Write a minimal 64 bit ELF file with a PT_DYNAMIC segment and no
+    section headers (like a stripped lib). The PT_LOAD segment is mapped at
+    0x1000 so the string table address has to be translated.
+
+    """
+    strtab = b"\0"
+    entries = b""
+    for name in needed:
+        entries += struct.pack("<qQ", 1, len(strtab))
+        strtab += name.encode() + b"\0"
+    phoff = 64
+    strtab_offset = phoff + 2 * 56
+    dyn_offset = strtab_offset + len(strtab)
+    entries += struct.pack("<qQ", 5, 0x1000 + strtab_offset)
+    entries += struct.pack("<qQ", 0, 0)
+    size = dyn_offset + len(entries)
+    header = b"\x7fELF\x02\x01\x01" + b"\0" * 9
+    header += struct.pack(
+        "<HHIQQQIHHHHHH", 3, 62, 1, 0, phoff, 0, 0, 64, 56, 2, 64, 0, 0
+    )
+    headers = struct.pack("<IIQQQQQQ", 1, 5, 0, 0x1000, 0x1000, size, size, 0x1000)
+    headers += struct.pack(
+        "<IIQQQQQQ",
+        2,
+        6,
+        dyn_offset,
+        0x1000 + dyn_offset,
+        0x1000 + dyn_offset,
+        len(entries),
+        len(entries),
+        8,
+    )
+    path.write_bytes(header + headers + strtab + entries)
+    return str(path)
+
+
+def test_read_elf_needed(tmp_path):
+    lib = write_elf(tmp_path / "lib._ssl.so", ["libssl.so", "libpython3.11.so"])
+    assert read_elf_needed(lib) == ["libssl.so", "libpython3.11.so"]
+    (tmp_path / "lib.py").write_text("x = 1\n")
+    assert read_elf_needed(str(tmp_path / "lib.py")) is None
+    (tmp_path / "libbad.so").write_bytes(b"\x7fELF\x02\x01\x01" + b"\0" * 20)
+    assert read_elf_needed(str(tmp_path / "libbad.so")) is None
+
+
+def test_find_reachable_libs(tmp_path):
+    libs = {
+        "libmain.so": write_elf(tmp_path / "libmain.so", ["libpython3.11.so"]),
+        "libpython3.11.so": write_elf(tmp_path / "libpython3.11.so", []),
+        "lib._ssl.so": write_elf(tmp_path / "lib._ssl.so", ["libssl.so"]),
+        "libssl.so": write_elf(tmp_path / "libssl.so", ["libcrypto.so"]),
+        "libcrypto.so": write_elf(tmp_path / "libcrypto.so", []),
+        "lib._sqlite3.so": write_elf(tmp_path / "lib._sqlite3.so", ["libsqlite3.so"]),
+        "libsqlite3.so": write_elf(tmp_path / "libsqlite3.so", []),
+    }
+    reachable = find_reachable_libs(libs, ["libmain.so", "lib._ssl.so"])
+    assert sorted(set(libs) - reachable) == ["lib._sqlite3.so", "libsqlite3.so"]
+
+    #: A lib that can't be parsed may need anything so everything is kept
+    (tmp_path / "libcrypto.so").write_bytes(b"\x7fELF")
+    assert find_reachable_libs(libs, ["libmain.so", "lib._ssl.so"]) == set(libs)
@@ -8,11 +8,31 @@ The full license is in the file COPYING.txt, distributed with this software.
 Created on Oct 31, 2017
 """
 import os
+import subprocess
+import sys
+from argparse import Namespace
 from contextlib import contextmanager
 
 import pytest
 
-from enamlnativecli.main import cd, sh, shprint
+from enamlnativecli import main
+from enamlnativecli.main import (
+    CommandFailed,
+    EnamlNativeCli,
+    ListPackages,
+    NdkBuild,
+    NdkStack,
+    PluginCommand,
+    cd,
+    conda_info,
+    conda_package_version,
+    conda_packages,
+    load_ctx,
+    run_commands,
+    run_in_daemon,
+    sh,
+    shprint,
+)
 
 
 @contextmanager
@@ -78,3 +98,317 @@ def test_build_app(capsys):
 #        sh.rm("-R", "tmp/enaml-native-test")
 #    cmd = sh.Command("enaml-native")
 #    shprint(cmd, "init-package", "enaml-native-test", "tmp/", _debug=True)
+
+
+def test_conda_packages(tmp_path):
+    meta = tmp_path / "conda-meta"
+    meta.mkdir()
+    (meta / "android-python-3.11.4-h1234_0.json").write_text("{}")
+    (meta / "history").write_text("")
+    assert conda_package_version("android-python", str(tmp_path)) == "3.11.4"
+    assert conda_package_version("enaml", str(tmp_path)) == ""
+
+    #: The cache is invalidated when a package is added
+    (meta / "enaml-0.19.0-py311_0.json").write_text("{}")
+    os.utime(meta, ns=(0, os.stat(meta).st_mtime_ns + 1))
+    packages = conda_packages(str(tmp_path))
+    assert packages["enaml"]["build"] == "py311_0"
+
+
+def test_list_packages(tmp_path, monkeypatch, capsys):
+    meta = tmp_path / "conda-meta"
+    meta.mkdir()
+    (meta / "enaml-0.19.0-py311_0.json").write_text(
+        '{"channel": "https://conda.anaconda.org/codelv/linux-64", '
+        '"subdir": "linux-64"}'
+    )
+    site_packages = tmp_path / "lib" / "python3.11" / "site-packages"
+    for info, installer in [
+        ("enaml-0.19.0.dist-info", "conda"),
+        ("enaml_native_cli-3.0.0.dist-info", "pip"),
+    ]:
+        (site_packages / info).mkdir(parents=True)
+        (site_packages / info / "INSTALLER").write_text(f"{installer}\n")
+    monkeypatch.setenv("CONDA_PREFIX", str(tmp_path))
+    cmd = ListPackages(cli=EnamlNativeCli(conda="conda"))
+    cmd.run(None)
+    lines = capsys.readouterr().out.splitlines()[3:]
+    assert [line.split() for line in lines] == [
+        ["enaml", "0.19.0", "py311_0", "codelv"],
+        ["enaml-native-cli", "3.0.0", "pypi_0", "pypi"],
+    ]
+
+    #: Without an active env the conda-meta in the cwd is not used
+    calls = []
+    monkeypatch.setattr(main, "shprint", lambda *args: calls.append(args))
+    monkeypatch.delenv("CONDA_PREFIX")
+    monkeypatch.chdir(tmp_path)
+    cmd.run(None)
+    assert calls == [("conda", "list")]
+
+
+def test_import_time():
+    """Benchmark importing the cli and make sure the slow dependencies are
+    only imported by the commands that use them.
+
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import enamlnativecli.main\n"
+        "print(time.perf_counter() - start)\n"
+        "print(' '.join(sys.modules))\n"
+    )
+    #: Warm up the pycs
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    elapsed, modules = result.stdout.splitlines()
+    print(f"Imported enamlnativecli.main in {float(elapsed) * 1000:.0f} ms")
+    for name in ("cookiecutter", "pkg_resources", "ruamel", "sh", "distutils"):
+        assert name not in modules.split()
+
+
+def test_plugin_commands_are_lazy(tmp_path, monkeypatch):
+    (tmp_path / "fake_plugin.py").write_text(
+        "from enamlnativecli.main import Command\n"
+        "class Hello(Command):\n"
+        "    title = 'hello'\n"
+        "    help = 'Say hello'\n"
+    )
+    dist = tmp_path / "fake_plugin-1.0.dist-info"
+    dist.mkdir()
+    (dist / "METADATA").write_text(
+        "Metadata-Version: 2.1\nName: fake-plugin\nVersion: 1.0\n"
+    )
+    (dist / "entry_points.txt").write_text(
+        "[enaml_native_command]\nhello = fake_plugin:Hello\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(main, "COMMANDS_CACHE", str(tmp_path / "commands.json"))
+
+    #: Loaded and cached the first time
+    monkeypatch.setattr(sys, "argv", ["enaml-native", "--help"])
+    titles = {c.title: c for c in EnamlNativeCli().commands}
+    assert "fake_plugin" in sys.modules
+    assert not isinstance(titles["hello"], PluginCommand)
+
+    #: Then only listed unless selected
+    del sys.modules["fake_plugin"]
+    titles = {c.title: c for c in EnamlNativeCli().commands}
+    assert "fake_plugin" not in sys.modules
+    assert isinstance(titles["hello"], PluginCommand)
+    assert titles["hello"].help == "Say hello"
+
+    monkeypatch.setattr(sys, "argv", ["enaml-native", "hello"])
+    titles = {c.title: c for c in EnamlNativeCli().commands}
+    assert "fake_plugin" in sys.modules
+    assert not isinstance(titles["hello"], PluginCommand)
+
+
+def test_conda_info_cache(tmp_path, monkeypatch):
+    calls = tmp_path / "calls"
+    conda = tmp_path / "bin" / "conda"
+    conda.parent.mkdir()
+    conda.write_text(
+        f'#!/bin/sh\necho >> {calls}\necho \'{{"active_prefix_name": "app"}}\'\n'
+    )
+    conda.chmod(0o755)
+    monkeypatch.setattr(main, "CONDA_CACHE", str(tmp_path / "conda.json"))
+    monkeypatch.setattr(main, "find_conda_path", lambda: str(conda))
+    monkeypatch.setenv("CONDA_PREFIX", str(tmp_path / "envs" / "app"))
+    monkeypatch.setenv("CONDA_DEFAULT_ENV", "app")
+
+    assert conda_info()["active_prefix_name"] == "app"
+    assert conda_info()["conda"] == str(conda)
+    assert len(calls.read_text().splitlines()) == 1
+
+    #: Refreshed when forced, the env changes or conda is updated
+    conda_info(refresh=True)
+    monkeypatch.setenv("CONDA_DEFAULT_ENV", "other")
+    conda_info()
+    os.utime(conda, ns=(0, 0))
+    conda_info()
+    assert len(calls.read_text().splitlines()) == 4
+
+
+def test_load_ctx_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "CTX_CACHE_DIR", str(tmp_path / "ctx"))
+    monkeypatch.setenv("CONDA_PREFIX", str(tmp_path / "venv"))
+    monkeypatch.chdir(tmp_path)
+    package = tmp_path / "environment.yml"
+    package.write_text(
+        "excluded: ['*.pyc']\n"
+        "bundle: {zipimport: true}\n"
+        "ios: {}\n"
+        "android: {excluded: ['tests'], bundle: {zipimport: false}}\n"
+    )
+    ctx = load_ctx(str(package))
+    android = ctx["android"]
+    assert android["excluded"] == ["tests", "*.pyc"]
+    assert android["bundle"] == {"zipimport": False}
+    assert ctx["ios"]["bundle"] == {"zipimport": True}
+    assert ctx["ios"]["conda_prefix"] == str(tmp_path / "venv")
+    assert ctx["ios"]["python_build_dir"] == str(tmp_path / "build" / "python")
+
+    #: Loaded from the cache until the file changes
+    assert load_ctx(str(package)) == ctx
+    assert len(os.listdir(tmp_path / "ctx")) == 1
+    package.write_text("name: not-an-app\n")
+    assert load_ctx(str(package)) == {}
+    assert len(os.listdir(tmp_path / "ctx")) == 2
+
+    #: Values json can't save are not cached
+    package.write_text("released: 2020-01-01\nios: {}\nandroid: {}\n")
+    assert str(load_ctx(str(package))["released"]) == "2020-01-01"
+    assert len(os.listdir(tmp_path / "ctx")) == 2
+
+    #: Only the most recent are kept
+    monkeypatch.setattr(main, "CTX_CACHE_LIMIT", 2)
+    package.write_text("name: other\n")
+    load_ctx(str(package))
+    assert len(os.listdir(tmp_path / "ctx")) == 2
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Requires unix sockets")
+def test_daemon(tmp_path, monkeypatch, capfd):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(
+        main, "DAEMON_DIR", str(tmp_path / "cache" / "enaml-native" / "daemon")
+    )
+    app = tmp_path / "app"
+    app.mkdir()
+    monkeypatch.chdir(app)
+    package = app / "environment.yml"
+    package.write_text("ios: {}\nandroid: {}\n")
+    try:
+        assert run_in_daemon(["ndk-build", "--help"]) == 0
+        assert "usage: enaml-native ndk-build" in capfd.readouterr().out
+        assert run_in_daemon(["not-a-command"]) == 2
+        assert "invalid choice" in capfd.readouterr().out
+
+        #: Restarted when the environment.yml changes
+        run_in_daemon([], "status")
+        pid = capfd.readouterr().out.split()[1]
+        package.write_text("ios: {}\nandroid: {}\nbundle: {}\n")
+        assert run_in_daemon(["--help"]) == 0
+        run_in_daemon([], "status")
+        assert capfd.readouterr().out.split()[1] != pid
+    finally:
+        run_in_daemon([], "stop")
+    assert run_in_daemon([], "status") is None
+
+
+def test_shprint(capsys):
+    python = sh.Command(sys.executable)
+    shprint(python, "-c", "print('a\\rb\\nc')")
+    assert capsys.readouterr().out.endswith("a\rb\nc\n\n")
+
+    #: Redraws are throttled but the last line is always shown
+    code = "for i in range(10000): print('line', i)"
+    shprint(python, "-c", code, _debug=False)
+    out = capsys.readouterr().out
+    assert out.count("\r[DEBUG]") < 100
+    assert "line 9999 " in out
+
+    with pytest.raises(sh.ErrorReturnCode):
+        shprint(python, "-c", "import sys; sys.exit(1)")
+
+
+def test_run_commands(capsys):
+    python = sys.executable
+    results = run_commands(
+        [
+            ("a", [python, "-c", "print('a\\r100%')"]),
+            ("b", [python, "-c", "import os; print(os.getcwd())"], {"cwd": "/"}),
+        ]
+    )
+    assert [(r.name, r.exit_code, r.tail) for r in results] == [
+        ("a", 0, ["100%"]),
+        ("b", 0, ["/"]),
+    ]
+    out = capsys.readouterr().out
+    assert "[a]\033[0;0m 100%" in out and "[b]\033[0;0m /" in out
+
+    #: A failure stops the others
+    with pytest.raises(CommandFailed) as e:
+        run_commands(
+            [
+                ("slow", [python, "-c", "import time; time.sleep(30)"]),
+                ("fail", [python, "-c", "import sys; sys.exit(3)"]),
+                ("next", [python, "-c", "print('never')"]),
+            ],
+            jobs=2,
+        )
+    slow, fail, never = e.value.results
+    assert e.value.result is fail and fail.exit_code == 3
+    assert slow.cancelled and slow.duration < 10
+    assert never.cancelled and not never.tail
+
+    results = run_commands([("x", ["false"]), ("y", ["true"])], check=False)
+    assert [r.exit_code for r in results] == [1, 0]
+
+
+def test_ndk_build_jobs(tmp_path, monkeypatch):
+    prefix = tmp_path / "venv"
+    (prefix / "conda-meta").mkdir(parents=True)
+    (prefix / "conda-meta" / "android-python-3.10.0-0.json").write_text("{}")
+    app_src = prefix / "android" / "enaml-native" / "src" / "main"
+    (app_src / "jni").mkdir(parents=True)
+    (app_src / "jni" / "Application.mk").write_text("APP_ABI := x86\n")
+    (app_src / "jni" / "Android.mk").write_text("PY_LIB_VER := 3.8\n")
+    ndk = tmp_path / "ndk"
+    ndk.mkdir()
+    (ndk / "ndk-build").write_text("#!/bin/sh\n")
+    (ndk / "ndk-build").chmod(0o755)
+    env = dict(
+        conda_prefix=str(prefix),
+        python_build_dir=str(tmp_path / "build"),
+        ndk=str(ndk),
+        targets=["x86_64", "arm64"],
+        excluded=[],
+        bundle={},
+    )
+    calls = []
+    monkeypatch.setattr(main, "shprint", lambda *args: calls.append(args))
+    monkeypatch.setattr(main, "run_commands", lambda *a, **kw: calls.append((a, kw)))
+    monkeypatch.chdir(tmp_path)
+    cmd = NdkBuild(ctx=dict(android=env, dependencies={}))
+    args = Namespace(
+        force=True, jobs=4, per_abi=False, strip=False, release=False, unused_libs=None
+    )
+    cmd.run(args)
+    assert [str(a) for a in calls.pop()] == [str(ndk / "ndk-build"), "-j4"]
+
+    #: Each ABI is built by it's own ndk-build with a share of the jobs
+    args.per_abi = True
+    cmd.run(args)
+    (commands,), kwargs = calls.pop()
+    assert kwargs == dict(jobs=2)
+    obj = app_src / "obj"
+    assert [(name, [str(a) for a in argv]) for name, argv in commands] == [
+        (
+            arch,
+            [
+                str(ndk / "ndk-build"),
+                "-j2",
+                f"APP_ABI={arch}",
+                f"NDK_OUT={obj / arch}",
+                f"NDK_LIBS_OUT={obj / arch}/libs",
+            ],
+        )
+        for arch in ("x86_64", "arm64-v8a")
+    ]
+
+    #: ndk-stack reads the symbols from the layout of the last build
+    ndk_stack = NdkStack(ctx=dict(android=env))
+    fake_sh = Namespace(Command=str, adb=lambda *args, **kwargs: "adb")
+    monkeypatch.setattr(main, "sh", fake_sh)
+    ndk_stack.run(Namespace(arch="x86_64"))
+    sym = "venv/android/enaml-native/src/main/obj/x86_64/local/x86_64"
+    assert calls.pop()[-1] == sym
+    args.per_abi = False
+    cmd.run(args)
+    ndk_stack.run(Namespace(arch="x86_64"))
+    assert calls.pop()[-1] == "venv/android/enaml-native/src/main/obj/local/x86_64"